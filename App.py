@@ -3,17 +3,19 @@ import json
 import os
 import dash
 import dash_auth
-import pydicom
 from dash import ALL, Dash, Input, Output, State
 from dash.exceptions import PreventUpdate
-from flask import request
+from flask import Response, abort, jsonify, request, stream_with_context
 import time
 
 # Importing Development Modules
 from Estimators.LVEF.lvef import lvef_estimation_pipeline
-from Estimators.LVGLS.estimate_lvgls import lvgls_estimation_pipeline
+from Estimators.LVGLS.estimate_lvgls import lvgls_estimation_pipeline, draw_tracked_points, TRACKED_POINT_RADIUS
+from Estimators.model_registry import load_models
+from diagnostics import DIAGNOSTICS_ENABLED, session_diagnostics_hook
 from layout_servers import *
 from utils import *
+from scan_cache import lvef_estimations, playback_frames
 import cvp
 
 # Keep this out of source code repository - save in a file or a database
@@ -41,6 +43,9 @@ auth = dash_auth.BasicAuth(
     valid_username_password_pairs
 )
 
+# Load and warm up the estimators' models once, at start-up, instead of on every estimation
+load_models()
+
 
 @app.callback(
     Output('patient_window_first_name','value'),
@@ -81,9 +86,9 @@ def patient_info_master(scan_thumbnails_children, reset_workspace_button_nclicks
         # load and display the desired patient info
         dicoms_dir = os.listdir(dicoms_filepath)
         if (os.path.exists(log_filepath) and len(dicoms_dir)>0 ):
-            # If there is at least one dicom, load the first one and grab the info
+            # If there is at least one dicom, read the first one's header and grab the info
             fname = dicoms_dir[0]
-            ds = pydicom.dcmread(dicoms_filepath+fname)
+            ds = fetch_scan_header(fname)
             p_name,p_last_name = str(ds.PatientName).split("^")
             p_dob = str(ds.PatientBirthDate) # str(YYYYMMDD)
             p_dob = p_dob[-2:] + '/' + p_dob[-4:-2] + '/' + p_dob[0:4]
@@ -441,28 +446,39 @@ def hidden_div_master(hidden_div_button_nclicks,end_of_study_window_button_nclic
         #print("Scan", filename, "was selected for LVEF estimation with index:",scan_index)
         write_to_log('user actions',filename+" was selected for LVEF estimation")
 
-        # Fetch the video and perform the LVEF estimation
-        video_rgb,dateTime,framerate = fetch_fields(filename,get_pixel_array=True,get_datetime=True,get_framerate=True)
-        start_time = time.time()
-        # Wrap the estimation pipeline with a try-except, so as to display an error message to the user should the estimation fail 
-        try:
-            lvef_estimation, border_masked_video,fully_masked_video = lvef_estimation_pipeline(video_rgb)
-        except Exception as e:
-            print(str(e))
-            return serve_estimation_error_window(str(e))
-        end_time = time.time()
-        exec_time = str(round(end_time-start_time,3)) + 's'
-
-        if (mask_display_value == "Border Mask"):
-            masked_video = border_masked_video
-        if (mask_display_value == "Full Mask"):
-            masked_video = fully_masked_video
+        dateTime,framerate = fetch_fields(filename,get_datetime=True,get_framerate=True)
+        # The estimation of a scan is the same every time, so it is cached (along with its mask overlay) and only performed when it is not
+        username = request.authorization['username']
+        lvef_results = lvef_estimations.get((username, filename))
+        if (lvef_results is None):
+            # Fetch the video and perform the LVEF estimation
+            # The estimators take the scan in its native (YBR) color space, getting its luminosity channel without any color conversion
+            scan = fetch_decoded_scan(filename)
+            start_time = time.time()
+            # Wrap the estimation pipeline with a try-except, so as to display an error message to the user should the estimation fail 
+            try:
+                lvef_estimation, lvef_spread, mask_overlay = lvef_estimation_pipeline(scan.pixel_array,scan.photometric_interpretation)
+            except Exception as e:
+                print(str(e))
+                return serve_estimation_error_window(str(e))
+            end_time = time.time()
+            exec_time = str(round(end_time-start_time,3)) + 's'
+            lvef_results = (lvef_estimation, lvef_spread, mask_overlay, exec_time)
+            lvef_estimations.put((username, filename), lvef_results)
+        lvef_estimation, lvef_spread, mask_overlay, exec_time = lvef_results
 
         # Display the results
         resize_factor = 1/(resize_percentage_slider_value/100)
-        videoHeight = int(masked_video.shape[1]/resize_factor)
-        videoWidth = int(masked_video.shape[2]/resize_factor)
-        image_pixels_list = prep_video_for_playback(masked_video,resize_factor)
+        videoHeight = int(mask_overlay.shape[1]/resize_factor)
+        videoWidth = int(mask_overlay.shape[2]/resize_factor)
+        # The masked video of a scan is the same on every estimation, so its playback frames are cached under the mask mode
+        # and only rendered (in the selected mask mode only) when they are not
+        playback_key = (username, filename, resize_percentage_slider_value, mask_display_value)
+        image_pixels_list = playback_frames.get(playback_key)
+        if (image_pixels_list is None):
+            masked_video = mask_overlay.render(mask_display_value)
+            image_pixels_list = prep_video_for_playback(masked_video,resize_factor)
+            playback_frames.put(playback_key, image_pixels_list)
 
         masked_video_cvp =  cvp.cornerstoneVP(
             id={"type":"estimation_result_window","index":"estimation_cvp"},
@@ -473,7 +489,7 @@ def hidden_div_master(hidden_div_button_nclicks,end_of_study_window_button_nclic
             imageWidth=videoWidth,
             framerate=framerate
         )
-        (new_window_children, new_window_style) = serve_LVEF_results_window(lvef_estimation,masked_video_cvp,exec_time)
+        (new_window_children, new_window_style) = serve_LVEF_results_window(lvef_estimation,masked_video_cvp,exec_time,lvef_spread)
         return (new_window_children, new_window_style)
 
     if (type_value == 'hidden_div_button' and index_value == 'LVGLS_button'):
@@ -492,12 +508,16 @@ def hidden_div_master(hidden_div_button_nclicks,end_of_study_window_button_nclic
         write_to_log('user actions',filename+" was selected for LVGLS estimation")
 
         # Fetch the video and perform the LVGLS estimation
-        video_rgb,dateTime,framerate = fetch_fields(filename,get_pixel_array=True,get_datetime=True,get_framerate=True)
+        # The estimators take the scan in its native (YBR) color space, getting its luminosity channel without any color conversion
+        scan = fetch_decoded_scan(filename)
+        dateTime,framerate = fetch_fields(filename,get_datetime=True,get_framerate=True)
         # Additionally measure estimation execution time
         start_time = time.time()
         # Wrap the estimation pipeline with a try-except, so as to display an error message to the user should the estimation fail
+        # Diagnostics plots are only collected (and saved in the session's Diagnostics directory) when enabled, see diagnostics.py
+        diagnostics_hook = session_diagnostics_hook(request.authorization['username'], filename) if DIAGNOSTICS_ENABLED else None
         try:
-            lvgls_estimation, masked_cut_video = lvgls_estimation_pipeline(video_rgb,framerate)
+            lvgls_estimation, cycle_video, tracked_points = lvgls_estimation_pipeline(scan.pixel_array,framerate,diagnostics_hook=diagnostics_hook,photometric_interpretation=scan.photometric_interpretation)
         except Exception as e:
             print(str(e))
             return serve_estimation_error_window(str(e))
@@ -506,9 +526,13 @@ def hidden_div_master(hidden_div_button_nclicks,end_of_study_window_button_nclic
 
         # Display the results
         resize_factor = 1/(resize_percentage_slider_value/100)
-        videoHeight = int(masked_cut_video.shape[1]/resize_factor)
-        videoWidth = int(masked_cut_video.shape[2]/resize_factor)
-        image_pixels_list = prep_video_for_playback(masked_cut_video,resize_factor)
+        videoHeight = int(cycle_video.shape[1]/resize_factor)
+        videoWidth = int(cycle_video.shape[2]/resize_factor)
+        # The tracked points are drawn after resizing the cycle's video, at the playback resolution
+        def draw_playback_points(video):
+            scale = video.shape[2]/cycle_video.shape[2]
+            draw_tracked_points(video, tracked_points*scale, radius=max(1, TRACKED_POINT_RADIUS*scale))
+        image_pixels_list = prep_video_for_playback(cycle_video,resize_factor,draw_overlay=draw_playback_points)
 
         masked_video_cvp =  cvp.cornerstoneVP(
             id={"type":"estimation_result_window","index":"estimation_cvp"},
@@ -609,11 +633,19 @@ def serve_scan_playback(scan_playbutton_nclicks, resize_percentage_slider_value)
 
         filename = index_dict[str(scan_index)]
         write_to_log('user actions',filename+"file requested for playback")
-        pixel_array_rgb,dateTime,framerate = fetch_fields(filename,get_pixel_array=True,get_datetime=True,get_framerate=True)
         resize_factor = 1/(resize_percentage_slider_value/100)
-        videoHeight = int(pixel_array_rgb.shape[1]/resize_factor)
-        videoWidth = int(pixel_array_rgb.shape[2]/resize_factor)
-        image_pixels_list = prep_video_for_playback(pixel_array_rgb,resize_factor)
+        playback_key = (username, filename, resize_percentage_slider_value, None)
+        cached_playback = playback_frames.get(playback_key)
+        if (cached_playback is None):
+            pixel_array_rgb,dateTime,framerate = fetch_fields(filename,get_pixel_array=True,get_datetime=True,get_framerate=True)
+            videoHeight = int(pixel_array_rgb.shape[1]/resize_factor)
+            videoWidth = int(pixel_array_rgb.shape[2]/resize_factor)
+            image_pixels_list = prep_video_for_playback(pixel_array_rgb,resize_factor)
+            playback_frames.put(playback_key, (image_pixels_list, videoHeight, videoWidth))
+        else:
+            print("---> Serving cached playback frames",flush=True)
+            image_pixels_list, videoHeight, videoWidth = cached_playback
+            dateTime,framerate = fetch_fields(filename,get_datetime=True,get_framerate=True)
 
         print("---> Returning props to the CVP with a resize factor of",resize_factor,flush=True)
         return (dateTime,filename,framerate,videoHeight,image_pixels_list,videoWidth)
@@ -674,6 +706,146 @@ def update_datetime(n_intervals):
     return serve_datetime()
 
 
+### Flask Routes ###
+# Served next to the Dash app by the same (authenticated) Flask server
+
+def parse_playback_request(scan_index):
+    """
+    Validates the scan index and the query parameters of a playback route request
+    Returns the scan's filename, the resize percentage and the image format, or aborts the request
+    The resize percentage must be in (0,100] and leave the resized frames (see resize_video()) at least one pixel high and wide
+    """
+    try:
+        filename = get_filename_from_index(scan_index)
+    except (KeyError, FileNotFoundError):
+        abort(404)
+    try:
+        resize_percentage = float(request.args.get('resize', 100))
+    except ValueError:
+        abort(400)
+    if (not (0 < resize_percentage <= 100)): # also rejects NaN
+        abort(400)
+    ds = fetch_scan_header(filename)
+    resize_factor = 1/(resize_percentage/100)
+    if (int(ds.Rows/resize_factor) < 1 or int(ds.Columns/resize_factor) < 1):
+        abort(400)
+    image_format = request.args.get('format', 'png')
+    if (image_format not in ('png', 'webp')):
+        abort(400)
+    return (filename, resize_percentage, image_format)
+
+@app.server.route('/playback/<scan_index>')
+def serve_playback_frames(scan_index):
+    """
+    Serves the frames of the scan with the given file_indexes index as compressed images,
+    a compact alternative to the imagePixelsList of float lists the cornerstoneVP is fed with.
+    Query parameters:
+        resize: the resize percentage of the frames (defaults to 100)
+        format: 'png' (default) or 'webp'
+    """
+    # Routes added after dash_auth's set-up are not protected by it, so check the credentials here
+    if (not auth.is_authorized()):
+        return auth.login_request()
+
+    filename, resize_percentage, image_format = parse_playback_request(scan_index)
+    pixel_array_rgb,dateTime,framerate = fetch_fields(filename,get_pixel_array=True,get_datetime=True,get_framerate=True)
+    resize_factor = 1/(resize_percentage/100)
+    video = resize_video(pixel_array_rgb, resize_factor)
+    return jsonify(
+        dicomName=filename,
+        dicomDateTime=dateTime,
+        framerate=float(framerate),
+        imageHeight=video.shape[1],
+        imageWidth=video.shape[2],
+        format=image_format,
+        frames=encode_playback_frames(video, image_format)
+    )
+
+@app.server.route('/playback/<scan_index>/frames/<int:frame_index>')
+def serve_playback_frame(scan_index, frame_index):
+    """
+    Serves a single frame of the scan with the given file_indexes index as an image,
+    decoding only that frame when the scan's pixel data allows it (see read_scan_frames()).
+    Takes the same query parameters as serve_playback_frames()
+    """
+    if (not auth.is_authorized()):
+        return auth.login_request()
+    filename, resize_percentage, image_format = parse_playback_request(scan_index)
+
+    frames, nframes = read_scan_frames(filename, frame_index, frame_index+1)
+    if (len(frames) == 0):
+        abort(404)
+    frame = resize_video(frames, 1/(resize_percentage/100))[0]
+    response = Response(encode_frame(frame, image_format), mimetype='image/' + image_format)
+    response.headers['X-Frame-Count'] = str(nframes)
+    return response
+
+@app.server.route('/playback/<scan_index>/frames')
+def serve_playback_frame_range(scan_index):
+    """
+    Streams frames [start, stop) of the scan with the given file_indexes index, so that playback can begin
+    as soon as the first frames arrive instead of after the entire scan has been processed.
+    Frames are decoded, resized and encoded in chunks of 'chunk' frames (query parameter, defaults to 4) as the
+    response is being sent. The body is a sequence of frames, each one a 4-byte big-endian length followed by the image bytes.
+    Takes the query parameters of serve_playback_frames(), plus 'start' (defaults to 0) and 'stop' (defaults to the last frame)
+    """
+    if (not auth.is_authorized()):
+        return auth.login_request()
+    filename, resize_percentage, image_format = parse_playback_request(scan_index)
+    try:
+        start = int(request.args.get('start', 0))
+        stop = request.args.get('stop')
+        stop = None if stop is None else int(stop)
+        chunk = int(request.args.get('chunk', 4))
+    except ValueError:
+        abort(400)
+    if (start < 0 or chunk < 1):
+        abort(400)
+    resize_factor = 1/(resize_percentage/100)
+
+    # Read the first chunk eagerly to learn the frame count (and fail before the response has started)
+    first_frames, nframes = read_scan_frames(filename, start, start+chunk if stop is None else min(start+chunk, stop))
+    stop = nframes if stop is None else min(stop, nframes)
+
+    def generate_frames():
+        frames = first_frames
+        chunk_start = start
+        while (len(frames) > 0):
+            for frame in resize_video(frames, resize_factor):
+                frame_bytes = encode_frame(frame, image_format)
+                yield len(frame_bytes).to_bytes(4, 'big') + frame_bytes
+            chunk_start += len(frames)
+            if (chunk_start >= stop):
+                break
+            frames, _ = read_scan_frames(filename, chunk_start, min(chunk_start+chunk, stop))
+
+    response = Response(stream_with_context(generate_frames()), mimetype='application/octet-stream')
+    response.headers['X-Frame-Count'] = str(nframes)
+    response.headers['X-Frame-Range'] = str(start) + '-' + str(stop)
+    response.headers['X-Image-Format'] = image_format
+    return response
+
+@app.server.route('/thumbnails/<scan_index>')
+def serve_scan_thumbnail_image(scan_index):
+    """
+    Serves the stored thumbnail (JPEG) of the scan with the given file_indexes index,
+    so that loading a session only sends the thumbnails' URLs to the page
+    """
+    if (not auth.is_authorized()):
+        return auth.login_request()
+    try:
+        filename = get_filename_from_index(scan_index)
+    except (KeyError, FileNotFoundError):
+        abort(404)
+    thumbnail_bytes = load_thumbnail(request.authorization['username'], filename)
+    if (thumbnail_bytes is None):
+        abort(404)
+    response = Response(thumbnail_bytes, mimetype='image/jpeg')
+    # Indexes are reused once their scan is deleted, so the browser must revalidate rather than reuse a cached thumbnail
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 if __name__ == '__main__':
     if is_docker():
         app.run_server(debug=False,host="0.0.0.0",port=8050)
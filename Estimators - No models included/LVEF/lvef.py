@@ -1,12 +1,17 @@
 import numpy as np
 from matplotlib import pyplot as plt
 import cv2
-import onnxruntime
 import pydicom
 from pydicom.pixel_data_handlers.util import convert_color_space
 
-def prep_dicom_video(video_rgb):    
-    pixel_array_ybr = convert_color_space(video_rgb,"RGB","YBR_FULL")
+from Estimators.model_registry import get_session
+
+def prep_dicom_video(video, photometric_interpretation="RGB"):
+    """
+    Turns the video (nframes,height,width,3) of color space photometric_interpretation ("RGB", or e.g. "YBR_FULL" for a DICOM's native pixel array)
+    to the (nframes,112,112,3) input of the EchoNet models, made of its luminosity ('y') channel only
+    """
+    pixel_array_ybr = luma_ready_video(video, photometric_interpretation)
     frames,height,width,channels = pixel_array_ybr.shape
 
     # This code section makes the image square by cropping the long dimension (at its center) to match the short one.
@@ -31,84 +36,121 @@ def prep_dicom_video(video_rgb):
     pixel_array_y_resized_rgb = np.transpose(pixel_array_y_resized_rgb, (3,1,2,0)) # From (channels, height, width, nframes) to (nframes, height, width, channels)
     return pixel_array_y_resized_rgb
 
-def segment_lv(segmentation_model_path, video_array):
-    # Normalize the video (pixel-wise) with the mean and std values provided by the EchoNet authors
+def luma_ready_video(video, photometric_interpretation):
+    """
+    Returns the video in a YBR color space, whose first channel is the luminosity ('y') channel.
+    Videos already in YBR (as the pixel data of the app's DICOM files is) are returned as they are, without any conversion.
+    """
+    if photometric_interpretation in ("YBR_FULL", "YBR_FULL_422"):
+        return video
+    return convert_color_space(video, photometric_interpretation, "YBR_FULL")
+
+SEGMENTATION_BATCH_SIZE = 16 # Frames per inference call of the segmentation model; bounds the memory of segment_lv() regardless of the scan's length
+
+def segment_lv(segmentation_model_path, video_array, batch_size=SEGMENTATION_BATCH_SIZE):
+    # The frames are normalized and fed to the model batch_size at a time (all at once if batch_size is None),
+    # so only one batch's float tensors are ever in memory. The model segments each frame independently,
+    # so the assembled mask is identical to that of a single inference call on the whole video.
+    ort_session = get_session(segmentation_model_path) # loaded once per process, see model_registry
+    input_name = ort_session.get_inputs()[0].name
+    nframes = video_array.shape[0]
+    if batch_size is None:
+        batch_size = max(nframes, 1)
+
+    # Mean and std values provided by the EchoNet authors
     mean = [33.741943, 33.877575, 34.1646]
     std = [51.184673, 51.356464, 51.660316]
-    video_array = (video_array - mean) / std # This is a standard step required by the model
 
-    # Reshape the model input as required by the segmentation model
-    video_array = (np.transpose(video_array, (0,3,1,2))).astype(np.float32) # Shape is (nframes, 3, 112, 112)
+    binary_mask = np.empty(video_array.shape[0:3], dtype=bool)
+    for start in range(0, nframes, batch_size):
+        batch = video_array[start:start+batch_size]
+        # Normalize the video (pixel-wise) with the mean and std values
+        batch = (batch - mean) / std # This is a standard step required by the model
+        # Reshape the model input as required by the segmentation model
+        batch = (np.transpose(batch, (0,3,1,2))).astype(np.float32) # Shape is (batch_size, 3, 112, 112)
 
-    # Perform the inference
-    ort_session = onnxruntime.InferenceSession(segmentation_model_path)
-    ort_input = {ort_session.get_inputs()[0].name: video_array}
-    ort_output = ort_session.run(None, ort_input)[0][:,0,:,:]
-    binary_mask = ort_output>0
+        # Perform the inference and assemble the mask
+        binary_mask[start:start+batch_size] = ort_session.run(None, {input_name: batch})[0][:,0,:,:] > 0
     return binary_mask # Shape is (nframes, 112, 112)
 
-def estimate_lvef(lvef_model_path, video_array):
+# The EchoNet LVEF model expects clips of 32 frames.
+# The original clip is expected to be at 50 FPS.
+# The 32-frame clips are sampled from the original clip by skipping every other frame (1:2 temporal subsampling).
+# If the original clip was at 25 FPS, we would not skip frames. If it was at 100 FPS, we would do 1:4 temporal subsampling.
+LVEF_CLIP_LENGTH = 32
+LVEF_CLIP_PERIOD = 2
+LVEF_CLIP_STRIDE = 16 # Frames of the original video between the beginnings of consecutive clips
+
+def estimate_lvef(lvef_model_path, video_array, clip_stride=LVEF_CLIP_STRIDE):
+    """
+    Estimates the LVEF on 32-frame clips sampled across the whole video (every clip_stride frames, plus one ending at the last frame),
+    with all clips fed to the model in a single batched inference call.
+    Videos shorter than a single clip are padded at the end with blank frames, as done by the EchoNet authors.
+    Returns the mean and the standard deviation of the per-clip estimates, along with the estimates themselves.
+    """
     # Normalize the video (pixel-wise) with the mean and std values provided by the EchoNet authors
     mean = [33.741943, 33.877575, 34.1646]
     std = [51.184673, 51.356464, 51.660316]
     video_array = (video_array - mean) / std # This is a standard step required by the model
 
-    # Reshape the model input as required by the segmentation model
-    video_array = (np.expand_dims(np.transpose(video_array, (3,0,1,2)), axis = 0)).astype(np.float32) # Shape is (1, 3, nframes, 112, 112)
-    # The following is a standard step required by the EchoNet LVEF model
-    # The model expects an input of 32 frames.
-    # The original clip is expected to be at 50 FPS. 
-    # This 32-frame clip should be sampled from the original clip by skipping every other frame (1:2 temporal subsampling).
-    # If the original clip was at 25 FPS, we would not skip frames. If it was at 100 FPS, we would do 1:4 temporal subsampling.
-    video_array = video_array[:,:,0:64:2,:,:] # Sample a 32-frame subclip with 1:2 temporal subsampling from the beginning of the video.
+    # Reshape the model input as required by the LVEF model
+    video_array = np.transpose(video_array, (3,0,1,2)).astype(np.float32) # Shape is (3, nframes, 112, 112)
+    clip_span = LVEF_CLIP_LENGTH * LVEF_CLIP_PERIOD # Frames of the original video a clip is sampled from
+    nframes = video_array.shape[1]
+    if nframes < clip_span:
+        # Pad with zeros, which after the normalization above are frames of the dataset's mean intensity
+        video_array = np.pad(video_array, ((0,0), (0,clip_span-nframes), (0,0), (0,0)))
+        nframes = clip_span
+    clip_starts = list(range(0, nframes - clip_span + 1, clip_stride))
+    if clip_starts[-1] != nframes - clip_span:
+        clip_starts.append(nframes - clip_span) # Make sure the end of the video is covered as well
+    clips = np.stack([video_array[:, start:start+clip_span:LVEF_CLIP_PERIOD] for start in clip_starts]) # Shape is (nclips, 3, 32, 112, 112)
 
     # Perform the inference
-    ort_session = onnxruntime.InferenceSession(lvef_model_path)
-    ort_input = {ort_session.get_inputs()[0].name: video_array}
-    lvef = ort_session.run(None, ort_input)[0][0][0]
-    
-    return lvef
+    ort_session = get_session(lvef_model_path) # loaded once per process, see model_registry
+    input_name = ort_session.get_inputs()[0].name
+    batch_dim = ort_session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim != len(clips):
+        # The model was exported with a fixed batch size (of one clip), so feed it the clips one by one
+        clip_lvefs = np.concatenate([ort_session.run(None, {input_name: clips[i:i+1]})[0][:,0] for i in range(len(clips))])
+    else:
+        clip_lvefs = ort_session.run(None, {input_name: clips})[0][:,0]
+
+    return (float(np.mean(clip_lvefs)), float(np.std(clip_lvefs)), clip_lvefs)
+
+BORDER_MASK_COLOR = (0,255,0) # green
+NO_RESIZE_FULL_MASK_COLOR = (255,0,0) # red
+
+def mask_borders(mask):
+    """
+    Returns the border of the mask (of format (nframes,height,width)) in every frame, i.e. the pixels of the mask
+    with at least one 4-connected neighbour outside of it (the image's edges counting as outside),
+    which are the pixels cv2.findContours() traces. Computed for all frames at once.
+    """
+    mask = mask.astype(bool)
+    padded_mask = np.pad(mask, ((0,0),(1,1),(1,1)))
+    # A pixel is interior if all four of its neighbours (up, down, left, right) belong to the mask
+    interior = padded_mask[:,:-2,1:-1] & padded_mask[:,2:,1:-1] & padded_mask[:,1:-1,:-2] & padded_mask[:,1:-1,2:]
+    return mask & ~interior
 
 def mask_video_no_resize(mask,video):
     """
     Mask the resized to mask's dimensions video with the mask produced by segment_lv
-    Returns the video in the mask's dimensions (112x112) with the mask applied on the border [1]
-    and on the whole area [2].
+    Returns the video in the mask's dimensions (112x112) with the mask applied on the whole area [1]
+    and on the border [2].
     """
-    border_masked_video = np.copy(video)
-    masked_video = np.copy(video)
-
-    for frame in range(0,mask.shape[0]):
-        # For border masked video
-        contours = cv2.findContours(mask[frame,:,:].astype(np.uint8),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)[0][0]
-        for i in range(0,contours.shape[0]):
-            x = contours[i,0,0]
-            y = contours[i,0,1]
-            border_masked_video[frame,y,x,0] = 0
-            border_masked_video[frame,y,x,1] = 255
-            border_masked_video[frame,y,x,2] = 0
-        # For masked video
-        for i in range(0,mask.shape[1]):
-            for j in range(0,mask.shape[2]):
-                if (mask[frame,i,j]):
-                    masked_video[frame,i,j,0] = 255
-                    masked_video[frame,i,j,1] = 0
-                    masked_video[frame,i,j,2] = 0
-    
+    mask = mask.astype(bool)[:,:,:,np.newaxis]
+    # Each output is rendered straight from the source video (one allocation each, no intermediate copies)
+    masked_video = np.where(mask, np.array(NO_RESIZE_FULL_MASK_COLOR, dtype=video.dtype), video)
+    border_masked_video = np.where(mask_borders(mask[:,:,:,0])[:,:,:,np.newaxis], np.array(BORDER_MASK_COLOR, dtype=video.dtype), video)
     return (masked_video,border_masked_video)
 
-def mask_video(mask,video_rgb):
+def upscale_mask(mask, height, width):
     """
-    Mask the original video with the mask produced by segment_lv
-    Returns the video in its original dimensions with the mask applied on the border [1]
-    and on the whole area [2].
+    Traverses backwards the steps that made the video (112,112) (see prep_dicom_video()),
+    turning the mask produced by segment_lv into a boolean mask of the original video's dimensions (nframes,height,width)
     """
-    print("Original Video shape:",video_rgb.shape)
-    print("Mask shape:",mask.shape)
-
-    # First, resize the mask to the video's shape
-    nframes, height, width, channels = video_rgb.shape
-    
+    nframes = mask.shape[0]
 
     # Steps to make video (112,112)
     # Starting Video Dimensions: (nframes,height,width)
@@ -124,8 +166,6 @@ def mask_video(mask,video_rgb):
     # 3. Resize (nframes,112,112) mask to (nframes,0.8*width,0.8*width) 
     # or (nframes,0.8*height,0.8*height) (whichever is smaller)
     # Example numbers in comments given for height=434 and width=636
-
-    mask = np.transpose(mask, (1,2,0)) # Change dims order to (height, width, nframes) as required by OpenCV below
     if height < width:
         new_dim = int(0.8*height) + 1  # rounding error avoided
         smaller = height
@@ -133,63 +173,114 @@ def mask_video(mask,video_rgb):
         # rarely happens to be height>width
         new_dim = int(0.8*width) + 1 # rounding error avoided
         smaller = width
-    mask = cv2.resize(mask.astype(np.uint8),(new_dim,new_dim),interpolation=cv2.INTER_CUBIC)
-    mask = np.transpose(mask, (2,0,1)) # Change back to (nframes, height, width)
+    resized_mask = np.empty((nframes,new_dim,new_dim), dtype=bool)
+    for start in range(0, nframes, 512): # OpenCV resizes images of up to 512 channels (here, frames) at a time
+        mask_batch = np.transpose(mask[start:start+512], (1,2,0)).astype(np.uint8) # Change dims order to (height, width, nframes) as required by OpenCV below
+        mask_batch = cv2.resize(mask_batch,(new_dim,new_dim),interpolation=cv2.INTER_CUBIC).reshape((new_dim,new_dim,-1))
+        resized_mask[start:start+512] = np.transpose(mask_batch, (2,0,1)) > 0 # Change back to (nframes, height, width)
 
     # 2. Add 20% (10% from bottom-top/left-right to both height and width)
     # (nframes,348,348) -> (nframes,434,434)
-    decropped_mask = np.zeros((nframes,smaller,smaller))
-    print("Decropped Mask shape:",decropped_mask.shape)
-    decropped_mask[:,int(smaller/10):(int(smaller/10) + mask.shape[1]), 
-                    int(smaller/10):(int(smaller/10) + mask.shape[2])] = mask[:,:,:]
-    mask = decropped_mask
-    
     # 1. Make the image rectangular by adding to the long dimension (at its center)
-    rect_mask = np.zeros((nframes,height,width))
+    # Both steps place the resized mask within an empty mask of the video's dimensions, at the offsets below
     bias = int(np.abs(width - height)/2)
-    if height < width:
-        rect_mask[:,:,bias:-bias] = mask[:,:,:]
-    else:
-        rect_mask[:,bias:-bias,:] = mask[:,:,:]
-    mask = rect_mask
-    #return(mask)
-
-    border_masked_video = np.copy(video_rgb)
-    fully_masked_video = np.copy(video_rgb)
-    for frame in range(0,mask.shape[0]):
-        # For border masked video
-        ans = cv2.findContours(mask[frame,:,:].astype(np.uint8),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
-        if(len(ans[0])>0):
-            # Sometimes, the second indexing will throw an error, so skip that frame
-            # Further investigation is required to determine how cv2.findContours behaves
-            # Until then, this simple check deals with the issue (could maybe try a try-except block) 
-            contours = ans[0][0]
-            for i in range(0,contours.shape[0]):
-                x = contours[i,0,0]
-                y = contours[i,0,1]
-                border_masked_video[frame,y,x,0] = 0
-                border_masked_video[frame,y,x,1] = 255
-                border_masked_video[frame,y,x,2] = 0
-        else:
-            print(ans[0])
-    # For fully masked video
-    fully_masked_video[:,:,:,2][np.where(mask)] = 255 # paint the lv chamber blue
-    return (border_masked_video,fully_masked_video)
+    row_offset = int(smaller/10) + (bias if height > width else 0)
+    col_offset = int(smaller/10) + (bias if height < width else 0)
+    rect_mask = np.zeros((nframes,height,width), dtype=bool)
+    rect_mask[:,row_offset:row_offset+new_dim,col_offset:col_offset+new_dim] = resized_mask[:,:height-row_offset,:width-col_offset]
+    return rect_mask
+
+# Each masked video is rendered straight from the source video (one allocation each, no intermediate copies)
+def render_border_mask(rect_mask, video_rgb):
+    """
+    Returns the video with the border of the (video-sized) mask painted on it
+    """
+    return np.where(mask_borders(rect_mask)[:,:,:,np.newaxis], np.array(BORDER_MASK_COLOR, dtype=video_rgb.dtype), video_rgb)
+
+def render_full_mask(rect_mask, video_rgb):
+    """
+    Returns the video with the whole area of the (video-sized) mask painted on it
+    """
+    fully_masked_video = np.array(video_rgb)
+    fully_masked_video[:,:,:,2][rect_mask] = 255 # paint the lv chamber blue
+    return fully_masked_video
+
+def mask_video(mask,video_rgb,max_frames=None):
+    """
+    Mask the original video with the mask produced by segment_lv
+    Returns the video in its original dimensions with the mask applied on the border [1]
+    and on the whole area [2].
+    Only the first max_frames frames are rendered and returned (all of them if max_frames is None).
+    """
+    if max_frames is not None:
+        mask = mask[0:max_frames]
+        video_rgb = video_rgb[0:max_frames]
+    print("Original Video shape:",video_rgb.shape)
+    print("Mask shape:",mask.shape)
+
+    # First, resize the mask to the video's shape
+    nframes, height, width, channels = video_rgb.shape
+    rect_mask = upscale_mask(mask, height, width)
+    return (render_border_mask(rect_mask, video_rgb),render_full_mask(rect_mask, video_rgb))
+
+class MaskOverlay:
+    """
+    The mask produced by segment_lv along with the original video it was produced from, rendering the masked video lazily:
+    only in the display mode requested and only for the first max_frames frames (the ones shown).
+    The mask is upscaled to the video's dimensions once, on the first render, so switching
+    display modes later costs a render and requires neither re-running the segmentation nor re-upscaling the mask.
+    """
+
+    DISPLAY_MODES = ('Border Mask', 'Full Mask') # As offered by the app's settings window
+
+    def __init__(self, mask, video_rgb, max_frames=None):
+        self.mask = mask[0:max_frames]
+        self.video_rgb = video_rgb[0:max_frames]
+        self._rect_mask = None
+
+    @property
+    def shape(self):
+        """
+        The shape of the rendered masked video, (nframes,height,width,3)
+        """
+        return self.video_rgb.shape
+
+    @property
+    def nbytes(self):
+        """
+        The memory footprint of the overlay, including its upscaled (boolean) mask, whether or not it has been computed yet
+        """
+        return self.mask.nbytes + self.video_rgb.nbytes + self.video_rgb[..., 0].size
+
+    def render(self, mask_display='Border Mask'):
+        """
+        Returns the masked video in the display mode mask_display ('Border Mask' or 'Full Mask')
+        """
+        if mask_display not in self.DISPLAY_MODES:
+            raise ValueError("Unknown mask display mode: " + str(mask_display))
+        if self._rect_mask is None:
+            self._rect_mask = upscale_mask(self.mask, self.video_rgb.shape[1], self.video_rgb.shape[2])
+        if mask_display == 'Border Mask':
+            return render_border_mask(self._rect_mask, self.video_rgb)
+        return render_full_mask(self._rect_mask, self.video_rgb)
 
-def lvef_estimation_pipeline(dicom_video_rgb):
+def lvef_estimation_pipeline(dicom_video, photometric_interpretation="RGB"):
     """
-    Provided the dicom pixel array, estimate the LVEF and return that
-    along with the video with the segmentation mask applied
+    Provided the dicom pixel array (in color space photometric_interpretation; pass the DICOM's native YBR array
+    to skip color conversions altogether), estimate the LVEF and return that (the mean of the per-clip estimates)
+    and its spread (their standard deviation), along with a MaskOverlay that holds the raw segmentation mask (nframes,112,112)
+    and renders the video with it applied
     """
     segmentation_model_path = './Estimators/LVEF/echonet_segmentation.onnx'
     lvef_model_path = './Estimators/LVEF/echonet_pretrained.onnx'
-    video_array = prep_dicom_video(dicom_video_rgb)
+    video_array = prep_dicom_video(dicom_video, photometric_interpretation)
     segmentation_array = segment_lv(segmentation_model_path=segmentation_model_path, video_array=video_array)
-    lvef = estimate_lvef(lvef_model_path=lvef_model_path, video_array=video_array)
-    (border_masked_video,fully_masked_video) = mask_video(segmentation_array, dicom_video_rgb)
+    lvef, lvef_spread, _ = estimate_lvef(lvef_model_path=lvef_model_path, video_array=video_array)
+    # The masked video is rendered later, on demand, and only for the first 64 frames (the only ones converted to RGB)
+    overlay_video_rgb = convert_color_space(dicom_video[0:64], photometric_interpretation, "RGB")
+    mask_overlay = MaskOverlay(segmentation_array, overlay_video_rgb, max_frames=64)
 
-    # Return only the first 64 frames
-    return (lvef,border_masked_video[0:64,:,:,:],fully_masked_video[0:64,:,:,:])
+    return (lvef,lvef_spread,mask_overlay)
 
 
 if ( __name__ == '__main__'):
@@ -198,17 +289,17 @@ if ( __name__ == '__main__'):
     lvef_model_path = 'C:/Users/konko/Desktop/Diploma/Echo_Web_App/Estimators/LVEF/echonet_pretrained.onnx'
 
     dataset = pydicom.dcmread(video_path, force=True)
-    video_array = prep_dicom_video(dataset.pixel_array)
+    video_array = prep_dicom_video(dataset.pixel_array, dataset.PhotometricInterpretation)
     segmentation_array = segment_lv(segmentation_model_path=segmentation_model_path, video_array=video_array)
     mask = mask_video(segmentation_array,dataset.pixel_array)
-    lvef = estimate_lvef(lvef_model_path=lvef_model_path, video_array=video_array)
+    lvef, lvef_spread, _ = estimate_lvef(lvef_model_path=lvef_model_path, video_array=video_array)
     #(masked_video,border_masked_video) = mask_video_no_resize(segmentation_array,video_array)
     #(masked_video,border_masked_video) = mask_video(segmentation_array, dataset.pixel_array)
 
     OG_video_rgb = convert_color_space(dataset.pixel_array,"YBR_FULL","RGB")
     #lvef,border_masked_video_ybr,fully_masked_video_ybr = lvef_estimation_pipeline(dataset.pixel_array)
     #mask = lvef_estimation_pipeline(dataset.pixel_array)
-    print("LVEF estimation:",lvef)
+    print("LVEF estimation:",lvef,"+-",lvef_spread)
     #fully_masked_video = convert_color_space(fully_masked_video_ybr,"YBR_FULL","RGB")
     
     # View the mask graphically
@@ -3,87 +3,153 @@ import numpy as np
 from skimage.morphology import skeletonize
 from pydicom.pixel_data_handlers.util import convert_color_space
 
-from Estimators.LVGLS.lvgls_pipeline_functions import segment_lv, detect_single_cardiac_cycle, get_lv_border_from_segmentation, get_path_from_lv_border, tracking_update, measure_strain
+from Estimators.LVGLS.lvgls_pipeline_functions import segment_lv, detect_single_cardiac_cycle, get_lv_border_from_segmentation, get_path_from_lv_border, track_lv_border_path, measure_strain, TRACKING_METHOD
 
-def estimate_lv_strain_from_DICOM_file(dicom_path):
+PREFERRED_IMAGE_SIZE_FOR_TRACKING = (568, 568) # This was chosen based on the dataset of ~30 patients from the Ippokratio Hospital; the optical flow parameters were tuned to this size
+# Some robustness w.r.t. image size has been observed experimentally.
+
+CHUNK_SIZE = 16 # Frames read, cropped, resized and segmented at a time
+# In incremental mode, frames stop being read once a cardiac cycle is confirmed on the frames read so far (see estimate_lv_strain_from_square_gray_frame_source())
+INCREMENTAL_CYCLE_DETECTION = True
+CYCLE_DETECTION_MIN_SECONDS = 3.0 # Cycle detection expects at least 3 cardiac cycles; 3 seconds cover 3 cycles at 60 bpm
+CYCLE_END_MARGIN_SECONDS = 0.5 # A detected cycle is confirmed once the frames read extend this far past its end
+
+# The tracked points are visualized as filled disks of this color and radius (in pixels of the scan)
+TRACKED_POINT_COLOR = (225,225,0)
+TRACKED_POINT_RADIUS = 3
+
+def estimate_lv_strain_from_DICOM_file(dicom_path, tracking_method=TRACKING_METHOD, diagnostics_hook=None):
     '''
     This function expects a path to a DICOM file containing an ECHO scan.
     It has only been tested with DICOM files from a GE Healthcare device with the Vivid S5 scanner.
-    The function loads the dicom file and:
-        - Converts it to YBR
-        - Sends a centered square crop of the luminosity (Y) channel to estimate_lv_strain_from_square_gray_frames_array()
-        - Returns the strain sequence and an RGB segment of the ECHO scan for visualization of the lv border tracking
+    The function loads the dicom file and sends its pixel array, in its native color space, to estimate_lv_strain_from_frames_array()
+    Returns the strain sequence and an RGB segment of the ECHO scan for visualization of the lv border tracking
     '''
 
-    # Load the video array from DICOM, convert to YBR and obtain Y channel
+    # Load the video array from DICOM
     dicom_contents = pydicom.dcmread(dicom_path, force=True)
-    framerate = dicom_contents.CineRate
-    pixel_array_ybr = convert_color_space(dicom_contents.pixel_array, dicom_contents.PhotometricInterpretation, 'YBR_FULL')
-    nframes,height,width,channels = pixel_array_ybr.shape
-    
-    # Make the image square by cropping the long dimension (at its center) to match the short one
-    bias = int(np.abs(width - height)/2)
-    if bias != 0:
-        if height < width:
-            image_type = 'Wide'
-            pixel_array_ybr = pixel_array_ybr[:, :, bias:-bias, :]
-        else:
-            image_type = 'Tall'
-            pixel_array_ybr = pixel_array_ybr[:, bias:-bias, :, :]
-    else: image_type = 'Square'
-    
-    # Send the luminosity ('Y') channel to the LVGLS estimation pipeline
-    strain_sequence, cardiac_cycle_framespan, tracked_lv_border_paths = estimate_lv_strain_from_square_gray_frames_array(pixel_array_ybr[:,:,:,0], framerate)
-
-    # Visualize results
-    pixel_array_rgb = convert_color_space(dicom_contents.pixel_array, dicom_contents.PhotometricInterpretation, 'RGB')[cardiac_cycle_framespan[0]:cardiac_cycle_framespan[1]]
-    for f in range(len(pixel_array_rgb)):
-        for p in range(len(tracked_lv_border_paths[f])):
-            coords = np.flip(np.round(tracked_lv_border_paths[f][p]).astype('int'))
-            if image_type =='Wide': coords[0] += bias
-            elif image_type == 'Tall': coords[1] += bias
-            cv2.circle(pixel_array_rgb[f], coords, color=(225,225,0), radius = 3, thickness = -1)
-
-    return strain_sequence, pixel_array_rgb
+    strain_sequence, cycle_video_rgb, tracked_points = estimate_lv_strain_from_frames_array(dicom_contents.pixel_array, dicom_contents.PhotometricInterpretation, dicom_contents.CineRate, tracking_method, diagnostics_hook)
+    return strain_sequence, draw_tracked_points(np.array(cycle_video_rgb), tracked_points)
 
-def estimate_lv_strain_from_RGB_frames_array(echo_scan_rgb, framerate):
+def estimate_lv_strain_from_RGB_frames_array(echo_scan_rgb, framerate, tracking_method=TRACKING_METHOD, diagnostics_hook=None):
     '''
     This funection expects a three-channel (RGB) ECHO scan in an array of shape (nframes, height, width, 3), along with its framerate.
     The entire ultrasound scan sector (i.e., the triangle-shape that contains the ultrasound image) should be visible and centered within the frame.
+    See estimate_lv_strain_from_frames_array(); returns the strain sequence and an RGB segment of the ECHO scan with the tracked lv border points drawn on it
+    '''
+    strain_sequence, cycle_video_rgb, tracked_points = estimate_lv_strain_from_frames_array(echo_scan_rgb, 'RGB', framerate, tracking_method, diagnostics_hook)
+    # Copy the cardiac cycle's frames to draw on them, echo_scan_rgb may be read-only (e.g. shared by the app's scan cache)
+    return strain_sequence, draw_tracked_points(np.array(cycle_video_rgb), tracked_points)
+
+def estimate_lv_strain_from_frames_array(echo_scan, photometric_interpretation, framerate, tracking_method=TRACKING_METHOD, diagnostics_hook=None):
+    '''
+    This function expects a three-channel ECHO scan in an array of shape (nframes, height, width, 3), in the color space photometric_interpretation
+    (e.g., 'YBR_FULL', as the pixel data of DICOM files usually is, or 'RGB'), along with its framerate.
+    The entire ultrasound scan sector (i.e., the triangle-shape that contains the ultrasound image) should be visible and centered within the frame.
     The function receives the scan and:
-        - Converts it to YBR
-        - Sends a centered square crop of the luminosity (Y) channel to estimate_lv_strain_from_square_gray_frames_array()
-        - Returns the strain sequence and an RGB segment of the ECHO scan for visualization of the lv border tracking
+        - Sends a centered square crop of the luminosity (Y) channel to estimate_lv_strain_from_square_gray_frame_source(); the Y channel
+          of YBR scans is taken as it is, while other scans are converted to YBR as their frames are read (only the frames up to the detected cardiac cycle are, in incremental mode)
+        - Returns the strain sequence, the RGB segment of the ECHO scan spanning the detected cardiac cycle (only that segment is converted to RGB;
+          it is a view of echo_scan for RGB scans, so it may be read-only), and the tracked lv border points on it, as an (nframes, npoints, 2) array of (x, y) coordinates.
+          The points are not drawn on the frames, so that they can be drawn at any resolution the frames are displayed in (see draw_tracked_points()).
     '''
-    
-    pixel_array_ybr = convert_color_space(echo_scan_rgb, 'RGB', 'YBR_FULL')
-    nframes,height,width,channels = pixel_array_ybr.shape
-    
+
     # Make the image square by cropping the long dimension (at its center) to match the short one
+    square_echo_scan, image_type, bias = centered_square_crop(echo_scan)
+
+    # Send the luminosity ('Y') channel to the LVGLS estimation pipeline
+    if photometric_interpretation in ('YBR_FULL', 'YBR_FULL_422'):
+        read_square_y_frames = lambda start, stop: square_echo_scan[start:stop,:,:,0]
+    else:
+        read_square_y_frames = lambda start, stop: convert_color_space(square_echo_scan[start:stop], photometric_interpretation, 'YBR_FULL')[:,:,:,0]
+    strain_sequence, cardiac_cycle_framespan, tracked_lv_border_paths = estimate_lv_strain_from_square_gray_frame_source(read_square_y_frames, len(square_echo_scan), framerate, tracking_method, diagnostics_hook)
+
+    # The cardiac cycle's frames, and the tracked points in the coordinates of the (uncropped) scan: (row, column) -> (x, y), undoing the square crop
+    cycle_video_rgb = convert_color_space(echo_scan[cardiac_cycle_framespan[0]:cardiac_cycle_framespan[1]], photometric_interpretation, 'RGB')
+    tracked_points = np.flip(tracked_lv_border_paths, axis=2)
+    if image_type == 'Wide': tracked_points = tracked_points + [bias, 0]
+    elif image_type == 'Tall': tracked_points = tracked_points + [0, bias]
+
+    return strain_sequence, cycle_video_rgb, tracked_points
+
+def draw_tracked_points(video, tracked_points, radius=TRACKED_POINT_RADIUS, color=TRACKED_POINT_COLOR):
+    '''
+    Draws the tracked points, an (nframes, npoints, 2) array of (x, y) coordinates, on the frames of video (nframes, height, width, channels) in place,
+    as filled disks of the given radius and color (on the first len(color) channels). The disks of all points of all frames are drawn at once.
+    Returns video.
+    '''
+    nframes, height, width = video.shape[0:3]
+    # The offsets of the pixels of a disk from its center
+    r = int(np.ceil(radius))
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    in_disk = dx**2 + dy**2 <= radius**2
+    dx, dy = dx[in_disk], dy[in_disk]
+
+    centers = np.rint(tracked_points).astype(int)
+    xs = centers[:, :, 0, np.newaxis] + dx # (nframes, npoints, disk pixels)
+    ys = centers[:, :, 1, np.newaxis] + dy
+    frames = np.broadcast_to(np.arange(nframes)[:, np.newaxis, np.newaxis], xs.shape)
+    visible = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    video[frames[visible], ys[visible], xs[visible], :len(color)] = color
+    return video
+
+def centered_square_crop(frames):
+    '''
+    Makes the (nframes, height, width, ...) frames square by cropping their long dimension (at its center) to match the short one.
+    Returns the square frames (a view of frames), along with the image type ('Wide', 'Tall' or 'Square') and the amount cropped off each side (bias)
+    '''
+    nframes, height, width = frames.shape[0:3]
     bias = int(np.abs(width - height)/2)
     if bias != 0:
         if height < width:
-            image_type = 'Wide'
-            pixel_array_ybr = pixel_array_ybr[:, :, bias:-bias, :]
-        else:
-            image_type = 'Tall'
-            pixel_array_ybr = pixel_array_ybr[:, bias:-bias, :, :]
-    else: image_type = 'Square'
-    
-    # Send the luminosity ('Y') channel to the LVGLS estimation pipeline
-    strain_sequence, cardiac_cycle_framespan, tracked_lv_border_paths = estimate_lv_strain_from_square_gray_frames_array(pixel_array_ybr[:,:,:,0], framerate)
+            return frames[:, :, bias:-bias], 'Wide', bias
+        return frames[:, bias:-bias, :], 'Tall', bias
+    return frames, 'Square', bias
 
-    pixel_array_rgb = echo_scan_rgb[cardiac_cycle_framespan[0]:cardiac_cycle_framespan[1]]
-    for f in range(len(pixel_array_rgb)):
-        for p in range(len(tracked_lv_border_paths[f])):
-            coords = np.flip(np.round(tracked_lv_border_paths[f][p]).astype('int'))
-            if image_type =='Wide': coords[0] += bias
-            elif image_type == 'Tall': coords[1] += bias
-            cv2.circle(pixel_array_rgb[f], coords, color=(225,225,0), radius = 3, thickness = -1)
+def prepare_frames_for_tracking(square_echo_scan_y):
+    '''
+    Crops 10% off all sides of the square (nframes, square_side, square_side) frames to remove the ECG plot and resizes them to the preferred image size for tracking.
+    Returns the resized frames, along with the amount cropped off each side and the scale factor of the resizing
+    (these will be used to later scale the tracked points coordinates back to the original image size)
+    '''
+    assert(square_echo_scan_y.shape[1] == square_echo_scan_y.shape[2])
 
-    return strain_sequence, pixel_array_rgb
+    original_square_side = square_echo_scan_y.shape[1]
+    crop_amount = int(original_square_side/10) # 10% was empirically chosen
+    square_echo_scan_y_cropped = square_echo_scan_y[:,crop_amount:(original_square_side - crop_amount), crop_amount:(original_square_side - crop_amount)]
+
+    scale_factor = square_echo_scan_y_cropped.shape[1] / PREFERRED_IMAGE_SIZE_FOR_TRACKING[0]
+    # It's not the exact size that matters, but that we are close enough; in any case, resizing to this size is the best we can do to ensure the conditions match 
+    if square_echo_scan_y_cropped.shape[1] != PREFERRED_IMAGE_SIZE_FOR_TRACKING[0]:
+        square_echo_scan_y_cropped = np.transpose(square_echo_scan_y_cropped, (1,2,0)) # Change dims order to (height, width, nframes) as required by OpenCV below
+        square_echo_scan_y_cropped = cv2.resize(square_echo_scan_y_cropped, PREFERRED_IMAGE_SIZE_FOR_TRACKING, interpolation=cv2.INTER_LINEAR).reshape(PREFERRED_IMAGE_SIZE_FOR_TRACKING + (-1,))
+        square_echo_scan_y_cropped = np.transpose(square_echo_scan_y_cropped, (2,0,1))
+    return square_echo_scan_y_cropped, crop_amount, scale_factor
 
-def estimate_lv_strain_from_square_gray_frames_array(square_echo_scan_y, framerate):
+def prepare_frames_for_segmentation(square_echo_scan_y_cropped):
+    '''
+    Resizes the (nframes, side, side) frames to 112x112 and turns them to 3-channel ones, as required by the EchoNet segmentation model
+    '''
+    square_echo_scan_y_cropped_transposed = np.transpose(square_echo_scan_y_cropped, (1,2,0)) # Change dims order to (height, width, nframes) as required by OpenCV below
+    square_echo_scan_y_cropped_resized = cv2.resize(square_echo_scan_y_cropped_transposed, (112,112), interpolation = cv2.INTER_CUBIC).reshape((112,112,-1)) # Resize all frames to 112x112 as required by the EchoNet models
+
+    square_echo_scan_y_cropped_resized_rgb = np.stack((square_echo_scan_y_cropped_resized, square_echo_scan_y_cropped_resized, square_echo_scan_y_cropped_resized), axis=0) # Turn the single-channel video to a 3-channel one (RGB with all channels equal), as required by the EchoNet models
+    return np.transpose(square_echo_scan_y_cropped_resized_rgb, (3,1,2,0)) # From (channels, height, width, nframes) to (nframes, height, width, channels)
+
+def cardiac_cycle_confirmed(lv_areas_sequence, framerate):
+    '''
+    Returns whether a cardiac cycle can be detected on the (partial) LV area sequence, ending at least CYCLE_END_MARGIN_SECONDS before the sequence does
+    (a cycle ending closer to the end of the sequence may be cut short, its end-diastole peak not having been fully recorded yet)
+    '''
+    if len(lv_areas_sequence) < CYCLE_DETECTION_MIN_SECONDS * framerate:
+        return False
+    try:
+        cycle_begin, cycle_end = detect_single_cardiac_cycle(lv_areas_sequence, framerate=framerate)
+    except (ValueError, IndexError): # Too few peaks or zero crossings detected so far
+        return False
+    return cycle_begin < cycle_end and cycle_end + CYCLE_END_MARGIN_SECONDS * framerate <= len(lv_areas_sequence)
+
+def estimate_lv_strain_from_square_gray_frames_array(square_echo_scan_y, framerate, tracking_method=TRACKING_METHOD, diagnostics_hook=None, incremental=INCREMENTAL_CYCLE_DETECTION):
     '''
     The function expects a single-channel (luminosity, or Y-channel only), square ECHO scan in an array of shape (nframes, square_side, square_side), along with its framerate.
     The entire ultrasound scan sector (i.e., the triangle-shape that contains the ultrasound image) should be visible and centered within the square.
@@ -92,49 +158,53 @@ def estimate_lv_strain_from_square_gray_frames_array(square_echo_scan_y, framera
         - segment the left ventricle (LV)
         - detect a singe cardiac cycle
         - find a path of points along the lv border
-        - track the path's points across the cardiac cycle with the Farneback method for optical flow estimation
+        - track the path's points across the cardiac cycle with optical flow estimation; by default with the Farneback method
+          (tracking_method selects the tracking backend, see TRACKING_METHODS in lvgls_pipeline_functions)
         - measure the tracked path's length across the cardiac cycle to derive the LV strain sequence
 
+    If a diagnostics_hook(name, data) is provided, it receives the pipeline's diagnostics (see detect_single_cardiac_cycle()).
+    In incremental mode, the frames after the first confirmed cardiac cycle are not processed (see estimate_lv_strain_from_square_gray_frame_source()).
+
     The function returns the:
         - strain sequence, 
         - framespan (startframe, endframe) of the detected cardiac cycle,
-        - the sequence of tracked lv border paths 
+        - the tracked lv border paths, as an (nframes, npoints, 2) array of (row, column) points 
     '''
+    return estimate_lv_strain_from_square_gray_frame_source(lambda start, stop: square_echo_scan_y[start:stop], len(square_echo_scan_y), framerate, tracking_method, diagnostics_hook, incremental)
 
-    # Make sure the scan is square and crop 10% off all sides to remove the ECG plot; resize to the preferred image size for tracking
-    assert(square_echo_scan_y.shape[1] == square_echo_scan_y.shape[2])
-
-    original_square_side = square_echo_scan_y.shape[1]
-    crop_amount = int(original_square_side/10) # 10% was empirically chosen
-    square_echo_scan_y_cropped = square_echo_scan_y[:,crop_amount:(original_square_side - crop_amount), crop_amount:(original_square_side - crop_amount)]
-
-    preferred_image_size_for_tracking = (568, 568) # This was chosen based on the dataset of ~30 patients from the Ippokratio Hospital; the optical flow parameters were tuned to this size
-    # Some robustness w.r.t. image size has been observed experimentally.
-    
-    scale_factor = square_echo_scan_y_cropped.shape[1] / preferred_image_size_for_tracking[0] # This will be used to later scale the tracked points coordinates back to the original image size
-    # It's not the exact size that matters, but that we are close enough; in any case, resizing to this size is the best we can do to ensure the conditions match 
-    if square_echo_scan_y_cropped.shape[1] != preferred_image_size_for_tracking[0]:
-        square_echo_scan_y_cropped = np.transpose(square_echo_scan_y_cropped, (1,2,0)) # Change dims order to (height, width, nframes) as required by OpenCV below
-        square_echo_scan_y_cropped = cv2.resize(square_echo_scan_y_cropped, preferred_image_size_for_tracking, interpolation=cv2.INTER_LINEAR)
-        square_echo_scan_y_cropped = np.transpose(square_echo_scan_y_cropped, (2,0,1))
-
-
-
-    # Prepare and feed the scan to the LV segmentation CNN to get the LV mask sequence
-    square_echo_scan_y_cropped_transposed = np.transpose(square_echo_scan_y_cropped, (1,2,0)) # Change dims order to (height, width, nframes) as required by OpenCV below
-    square_echo_scan_y_cropped_resized = cv2.resize(square_echo_scan_y_cropped_transposed, (112,112), interpolation = cv2.INTER_CUBIC) # Resize all frames to 112x112 as required by the EchoNet models
-
-    square_echo_scan_y_cropped_resized_rgb = np.stack((square_echo_scan_y_cropped_resized, square_echo_scan_y_cropped_resized, square_echo_scan_y_cropped_resized), axis=0) # Turn the single-channel video to a 3-channel one (RGB with all channels equal), as required by the EchoNet models
-    square_echo_scan_y_cropped_resized_rgb = np.transpose(square_echo_scan_y_cropped_resized_rgb, (3,1,2,0)) # From (channels, height, width, nframes) to (nframes, height, width, channels)
+def estimate_lv_strain_from_square_gray_frame_source(read_square_y_frames, nframes, framerate, tracking_method=TRACKING_METHOD, diagnostics_hook=None, incremental=INCREMENTAL_CYCLE_DETECTION, chunk_size=CHUNK_SIZE):
+    '''
+    Same as estimate_lv_strain_from_square_gray_frames_array(), for a scan of nframes frames read on demand:
+    read_square_y_frames(start, stop) should return the square, single-channel frames [start, stop) in an array of shape (stop-start, square_side, square_side).
 
-    lv_mask_sequence = segment_lv('Estimators/LVGLS/echonet_segmentation.onnx', square_echo_scan_y_cropped_resized_rgb)
+    The frames are read, cropped, resized and segmented in chunks of chunk_size frames. In incremental mode, cardiac cycle detection is attempted
+    on the LV area sequence of the frames segmented so far after every chunk, and no more chunks are read once a cycle is confirmed (see cardiac_cycle_confirmed()),
+    so the work done scales with one cardiac cycle instead of the entire scan. Otherwise (or if no cycle is confirmed before the end of the scan), 
+    the cycle is detected on the LV area sequence of the entire scan.
+    '''
+    # Prepare and feed the scan to the LV segmentation CNN chunk by chunk, to get the LV mask sequence
+    square_echo_scan_y_cropped_chunks = []
+    lv_mask_sequence_chunks = []
+    lv_areas_sequence_chunks = []
+    for chunk_start in range(0, nframes, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, nframes)
+        # Crop and resize the frames to the preferred image size for tracking
+        square_echo_scan_y_cropped, crop_amount, scale_factor = prepare_frames_for_tracking(read_square_y_frames(chunk_start, chunk_stop))
+        lv_mask_sequence = segment_lv('Estimators/LVGLS/echonet_segmentation.onnx', prepare_frames_for_segmentation(square_echo_scan_y_cropped))
+
+        square_echo_scan_y_cropped_chunks.append(square_echo_scan_y_cropped)
+        lv_mask_sequence_chunks.append(lv_mask_sequence)
+        lv_areas_sequence_chunks.append(np.sum(lv_mask_sequence, axis=(1,2))) # approximate the LV area at every frame by summing the mask's pixels
+        if incremental and chunk_stop < nframes and cardiac_cycle_confirmed(np.concatenate(lv_areas_sequence_chunks), framerate):
+            break
+    lv_mask_sequence = np.concatenate(lv_mask_sequence_chunks)
+    lv_areas_sequence = np.concatenate(lv_areas_sequence_chunks)
 
 
     
     # Detect and isolate a single cardiac cycle using the LV mask sequence
-    lv_areas_sequence = np.sum(lv_mask_sequence, axis=(1,2)) # approximate the LV area at every frame by summing the mask's pixels
-    cardiac_cycle_framespan = detect_single_cardiac_cycle(lv_areas_sequence, framerate=framerate, debug=True)
-    square_echo_scan_y_cropped = square_echo_scan_y_cropped[cardiac_cycle_framespan[0]:cardiac_cycle_framespan[1]]
+    cardiac_cycle_framespan = detect_single_cardiac_cycle(lv_areas_sequence, framerate=framerate, diagnostics_hook=diagnostics_hook)
+    square_echo_scan_y_cropped = np.concatenate(square_echo_scan_y_cropped_chunks)[cardiac_cycle_framespan[0]:cardiac_cycle_framespan[1]]
 
 
 
@@ -163,7 +233,7 @@ def estimate_lv_strain_from_square_gray_frames_array(square_echo_scan_y, framera
 
 
     # Resize the initial lv_border to match the (resized) echo scan dimensions
-    resized_initial_lv_border = cv2.resize(1.0 * initial_lv_border, preferred_image_size_for_tracking, interpolation=cv2.INTER_LINEAR)
+    resized_initial_lv_border = cv2.resize(1.0 * initial_lv_border, PREFERRED_IMAGE_SIZE_FOR_TRACKING, interpolation=cv2.INTER_LINEAR)
     # Smoothen the resized lv_border in order to avoid jagged edges and sharp turns which can cause problems in get_path_from_lv_border() later on
     smooth_resized_initial_lv_border = cv2.medianBlur((1.0*(resized_initial_lv_border>0)).astype('uint8'), 13) # 13 is the size of the filter; again, chosen empirically so that it doesn't distort the overall shape but smooths the edges
     smooth_resized_initial_lv_border = 1.0 * ( skeletonize(smooth_resized_initial_lv_border, method='lee') > 0 )
@@ -188,29 +258,22 @@ def estimate_lv_strain_from_square_gray_frames_array(square_echo_scan_y, framera
 
 
 
-    # Calculate the optical flow between consecutive frames of the echo scan using the Farneback method
-    # The parameters of the method were chosen empirically in a trial-and-error fashion and by manual visualization of the results on the dataset of ~30 patients from the Ippokratio Hospital
-    optical_flows = []
-    for i in range(len(square_echo_scan_y_cropped) - 1):
-        frame1 = square_echo_scan_y_cropped[i]
-        frame2 = square_echo_scan_y_cropped[i+1]
-        optical_flows.append(cv2.calcOpticalFlowFarneback(prev=frame1, next=frame2, flow=None, pyr_scale=0.5, levels=3, winsize=41, iterations=5, poly_n=5, poly_sigma=1.1, flags=0))
-
-
-    # Perform tracking of the lv_border paths (of points) using the calculated optical flows
-    tracked_lv_border_paths = tracking_update([resampled_smooth_resized_initial_lv_border_path], optical_flows)
+    # Perform tracking of the lv_border paths (of points) across the cardiac cycle using optical flow between consecutive frames of the echo scan
+    tracked_lv_border_paths = track_lv_border_path(resampled_smooth_resized_initial_lv_border_path, square_echo_scan_y_cropped, method=tracking_method)
     # Measure strain using the tracked lv_border paths
     strain_sequence = measure_strain(tracked_lv_border_paths)
     # Rescale and pad the tracked lv_border path points (essentially undo the 10% crop and resizing that were performed initially)
-    rescaled_padded_tracked_lv_border_paths = [(scale_factor * tcp + crop_amount).astype(int) for tcp in tracked_lv_border_paths]
+    rescaled_padded_tracked_lv_border_paths = (scale_factor * tracked_lv_border_paths + crop_amount).astype(int)
 
     return strain_sequence, cardiac_cycle_framespan, rescaled_padded_tracked_lv_border_paths
 
 # Exported pipeline function
-def lvgls_estimation_pipeline(dicom_video_rgb,framerate):
+def lvgls_estimation_pipeline(dicom_video,framerate,tracking_method=TRACKING_METHOD,diagnostics_hook=None,photometric_interpretation='RGB'):
     """
-    Provided the dicom pixel array, estimate the LVGLS percentage and return that
-    along with the video with the segmentation mask applied
+    Provided the dicom pixel array (in color space photometric_interpretation; pass the DICOM's native YBR array
+    to skip color conversions of the frames processed), estimate the LVGLS percentage and return that
+    along with the RGB video of the cardiac cycle it was estimated on and the tracked lv border points on it
+    (to draw on the video with draw_tracked_points(), at the resolution it is displayed in)
     """
-    gls_timeseries, masked_cut_video = estimate_lv_strain_from_RGB_frames_array(dicom_video_rgb,framerate)
-    return np.nanmin(gls_timeseries)*100,masked_cut_video
+    gls_timeseries, cycle_video_rgb, tracked_points = estimate_lv_strain_from_frames_array(dicom_video,photometric_interpretation,framerate,tracking_method,diagnostics_hook)
+    return np.nanmin(gls_timeseries)*100,cycle_video_rgb,tracked_points
@@ -1,34 +1,71 @@
+import os
+from collections import deque
 import cv2
 import numpy as np
-import onnxruntime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import scipy
 from scipy.signal import savgol_filter
 from scipy.interpolate import splprep, splev
-
-import astropy.units as u
-
-from matplotlib import pyplot as plt
-from fil_finder import FilFinder2D
+from scipy.ndimage import map_coordinates
+from skimage.morphology import skeletonize
 
 import heartpy as hp
 
-def segment_lv(segmentation_model_path, video_array):
-    # Normalize the video (pixel-wise) with the mean and std values provided by the EchoNet authors
+from Estimators.model_registry import get_session
+
+# Skeletons (connected components) and end branches of the lv border skeleton shorter than these (in pixels) are pruned, see prune_skeleton()
+SKELETON_MIN_LENGTH = 40
+BRANCH_MIN_LENGTH = 40
+STRAIN_SPLINE_SAMPLES = 10 # Points sampled along the spline fit of the tracked lv border to measure its length, see measure_strain()
+STRAIN_SEGMENTS = 6 # Segments of the lv border with a strain sequence each (basal, mid and apical, on each of the two walls)
+
+# The 8 neighbours of a pixel, in clockwise order around it starting from the one above
+RING_OFFSETS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+SEGMENTATION_BATCH_SIZE = 16 # Frames per inference call of the segmentation model; bounds the memory of segment_lv() regardless of the scan's length
+
+# Backends for tracking the lv border points across the cardiac cycle (see track_lv_border_path()):
+#   'farneback': dense Farneback optical flow over the whole frame (the reference method)
+#   'farneback_band': dense Farneback optical flow only within a band (bounding box plus margin) around the initial lv border
+#   'lucas_kanade': sparse pyramidal Lucas-Kanade optical flow on the tracked points only
+TRACKING_METHODS = ('farneback', 'farneback_band', 'lucas_kanade')
+TRACKING_METHOD = 'farneback' # The default backend
+# The parameters of the Farneback method were chosen empirically in a trial-and-error fashion and by manual visualization of the results on the dataset of ~30 patients from the Ippokratio Hospital
+FARNEBACK_PARAMS = dict(pyr_scale=0.5, levels=3, winsize=41, iterations=5, poly_n=5, poly_sigma=1.1, flags=0)
+# The optical flows of the frame pairs are independent, so they are computed in a pool of FLOW_WORKERS workers (see farneback_optical_flows())
+FLOW_WORKERS = None # None uses one worker per CPU
+FLOW_POOL = 'thread' # 'thread' (OpenCV releases the GIL while computing the flow) or 'process'
+TRACKING_BAND_MARGIN = 80 # Margin (in pixels of the 568x568 tracking frames) around the initial lv border's bounding box; must cover the border's motion over a cycle
+# Window size and pyramid levels of the Lucas-Kanade method match those of the Farneback method above
+LUCAS_KANADE_PARAMS = dict(winSize=(41, 41), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+def segment_lv(segmentation_model_path, video_array, batch_size=SEGMENTATION_BATCH_SIZE):
+    # The frames are normalized and fed to the model batch_size at a time (all at once if batch_size is None),
+    # so only one batch's float tensors are ever in memory. The model segments each frame independently,
+    # so the assembled mask is identical to that of a single inference call on the whole video.
+    ort_session = get_session(segmentation_model_path) # loaded once per process, see model_registry
+    input_name = ort_session.get_inputs()[0].name
+    nframes = video_array.shape[0]
+    if batch_size is None:
+        batch_size = max(nframes, 1)
+
+    # Mean and std values provided by the EchoNet authors
     mean = [33.741943, 33.877575, 34.1646]
     std = [51.184673, 51.356464, 51.660316]
-    video_array = (video_array - mean) / std # This is a standard step required by the model
 
-    # Reshape the model input as required by the segmentation model
-    video_array = (np.transpose(video_array, (0,3,1,2))).astype(np.float32) # Shape is (nframes, 3, 112, 112)
+    binary_mask = np.empty(video_array.shape[0:3], dtype=bool)
+    for start in range(0, nframes, batch_size):
+        batch = video_array[start:start+batch_size]
+        # Normalize the video (pixel-wise) with the mean and std values
+        batch = (batch - mean) / std # This is a standard step required by the model
+        # Reshape the model input as required by the segmentation model
+        batch = (np.transpose(batch, (0,3,1,2))).astype(np.float32) # Shape is (batch_size, 3, 112, 112)
 
-    # Perform the inference
-    ort_session = onnxruntime.InferenceSession(segmentation_model_path)
-    ort_input = {ort_session.get_inputs()[0].name: video_array}
-    ort_output = ort_session.run(None, ort_input)[0][:,0,:,:]
-    binary_mask = ort_output>0
+        # Perform the inference and assemble the mask
+        binary_mask[start:start+batch_size] = ort_session.run(None, {input_name: batch})[0][:,0,:,:] > 0
     return binary_mask # Shape is (nframes, 112, 112)
 
-def detect_single_cardiac_cycle(endo_areas_sequence, framerate, debug=False):
+def detect_single_cardiac_cycle(endo_areas_sequence, framerate, diagnostics_hook=None):
     '''
     The function receives a sequence of values representing areas of the LV endocardium at each frame of an ECHO scan.
     The sequence is expected to be AT LEAST 3 CARDIAC CYCLES long.
@@ -41,7 +78,8 @@ def detect_single_cardiac_cycle(endo_areas_sequence, framerate, debug=False):
 
     To detect a single cardiac cycle, we select the first detected peak that is distanced from frame 0 by at least the mean half cycle length.
     This way we may ignore a peak that is near the beginning of the sequence, but we make sure that the selected peak will be an end-diastole moment.
-    
+
+    If a diagnostics_hook(name, data) is provided, it is called with the signals and values of the detection (for plotting, see diagnostics.py).
     '''
 
     endo_areas_sequence = np.asarray(
@@ -73,7 +111,9 @@ def detect_single_cardiac_cycle(endo_areas_sequence, framerate, debug=False):
 
     end_diastole_frames, _ = scipy.signal.find_peaks(endo_areas_sequence, height=endo_areas_mean,
                                                      distance=max_half_cycle_length)
-    
+    if len(end_diastole_frames) == 0:
+        raise ValueError("No end-diastole frames detected in the LV area sequence")
+
     for i in range(len(end_diastole_frames)): # Iterate through all end_diastole_frames 
         if end_diastole_frames[i] >= mean_half_cycle_length: break # stop iterating as soon as an entry >= mean_half_cycle_length is found
     cycle_begin = end_diastole_frames[i]
@@ -84,19 +124,18 @@ def detect_single_cardiac_cycle(endo_areas_sequence, framerate, debug=False):
 
     cardiac_cycle_frames = [cycle_begin, cycle_end]
 
-    if debug:
-        plt.figure()
-        plt.plot(endo_areas_sequence)
-        plt.plot(cardiac_cycle_frames, endo_areas_sequence[cardiac_cycle_frames], 'o')
-        plt.plot(max_half_cycle_length, endo_areas_mean, '*')
-        plt.plot(mean_half_cycle_length, endo_areas_mean, 'x')
-        plt.plot(endo_areas_filtered + endo_areas_mean)
-        plt.axhline(endo_areas_filtered_mean)
+    if diagnostics_hook is not None:
+        diagnostics_hook('cardiac_cycle_detection', dict(
+            endo_areas_sequence=endo_areas_sequence, endo_areas_filtered=endo_areas_filtered, cardiac_cycle_frames=cardiac_cycle_frames,
+            max_half_cycle_length=max_half_cycle_length, mean_half_cycle_length=mean_half_cycle_length,
+            endo_areas_mean=endo_areas_mean, endo_areas_filtered_mean=endo_areas_filtered_mean))
 
     return cardiac_cycle_frames
 
-def get_lv_border_from_segmentation(binary_mask):
-
+def get_open_lv_contour(binary_mask):
+    '''
+    Returns the (112, 112) image of the outer contour of the (112, 112) binary LV mask, without its bottom (basal) lines
+    '''
     b = binary_mask.astype(np.uint8)
 
     i = np.squeeze(cv2.findContours(b, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[0][0])
@@ -137,102 +176,293 @@ def get_lv_border_from_segmentation(binary_mask):
     not_hitormiss[0:55, :] = 1
     final = cv2.bitwise_and(image, not_hitormiss)
 
-    fil = FilFinder2D(final, distance=250 * u.pc, mask=final)
-    fil.preprocess_image(flatten_percent=85)
-    fil.create_mask(border_masking=True, verbose=False,
-                    use_existing_mask=True)
-    fil.medskel(verbose=False)
-    fil.analyze_skeletons(branch_thresh=40 * u.pix, skel_thresh=40 * u.pix, prune_criteria='length')
-
-    sth = np.array(fil.skeleton)
+    return final
 
-    return sth 
+def skeleton_crossing_numbers(skeleton):
+    '''
+    Returns, for every pixel of the binary skeleton image, the number of separate groups of skeleton pixels among its 8 neighbours
+    (the number of background-to-skeleton transitions going around it): 1 at the end of a branch, 2 along a branch and 3 or more at a junction
+    '''
+    padded = np.pad(skeleton, 1).astype(np.int8)
+    height, width = skeleton.shape
+    ring = [padded[1+dr:1+dr+height, 1+dc:1+dc+width] for dr, dc in RING_OFFSETS]
+    return sum((1 - ring[i]) * ring[(i+1) % 8] for i in range(8))
 
-def findPathBwTwoPoints(k, start, end):
+def skeleton_neighbours(skeleton, pixel):
+    '''
+    Returns the (row, column) skeleton pixels among the 8 neighbours of pixel
+    '''
+    row, col = pixel
+    height, width = skeleton.shape
+    return [(row+dr, col+dc) for dr, dc in RING_OFFSETS if 0 <= row+dr < height and 0 <= col+dc < width and skeleton[row+dr, col+dc]]
 
-    # All 8 directions
-    delta = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+def farthest_skeleton_pixel(skeleton, start):
+    '''
+    Returns the skeleton pixel farthest from start (in steps along the skeleton), among the pixels connected to it
+    '''
+    distances = {start: 0}
+    queue = deque([start])
+    farthest = start
+    while queue:
+        pixel = queue.popleft()
+        for neighbour in skeleton_neighbours(skeleton, pixel):
+            if neighbour not in distances:
+                distances[neighbour] = distances[pixel] + 1
+                queue.append(neighbour)
+                if distances[neighbour] > distances[farthest]:
+                    farthest = neighbour
+    return farthest
+
+def trace_end_branch(skeleton, crossing_numbers, end_point, max_length):
+    '''
+    Returns the set of pixels of the branch running from end_point up to the first junction it meets (excluding the junction),
+    or None if the branch is at least max_length pixels long or meets no junction (i.e., it is a whole, unbranched skeleton)
+    '''
+    branch = {end_point}
+    frontier = [end_point]
+    meets_junction = False
+    while frontier:
+        pixel = frontier.pop()
+        neighbours = skeleton_neighbours(skeleton, pixel)
+        if any(crossing_numbers[neighbour] >= 3 for neighbour in neighbours):
+            meets_junction = True # The branch ends next to the junction, don't follow the junction's other branches
+            continue
+        for neighbour in neighbours:
+            if neighbour not in branch:
+                branch.add(neighbour)
+                frontier.append(neighbour)
+        if len(branch) >= max_length:
+            return None
+    return branch if meets_junction else None
+
+def prune_skeleton(binary_image, skeleton_min_length=SKELETON_MIN_LENGTH, branch_min_length=BRANCH_MIN_LENGTH):
+    '''
+    Skeletonizes the binary image, removes the skeletons (connected components) shorter than skeleton_min_length pixels,
+    and then iteratively prunes the end branches (those running from an end point to a junction) shorter than branch_min_length pixels,
+    except for those on the longest path of each skeleton, until none is left. Returns the pruned skeleton as a uint8 (0 or 1) image.
+    Meant for small images, such as the (112, 112) lv contours; this does what FilFinder2D's skeleton analysis did here (length pruning),
+    without its dependencies (astropy) and set-up costs.
+    '''
+    skeleton = skeletonize(binary_image > 0).astype(np.uint8)
+
+    # Remove the short skeletons
+    nskeletons, labels, stats, _ = cv2.connectedComponentsWithStats(skeleton, connectivity=8)
+    long_skeletons = stats[:, cv2.CC_STAT_AREA] >= skeleton_min_length
+    long_skeletons[0] = False # label 0 is the background
+    skeleton = long_skeletons[labels].astype(np.uint8)
+
+    # The ends of the longest path of every skeleton (found with a double sweep: the pixel farthest from any pixel,
+    # and the pixel farthest from that) are kept, so that pruning never shortens the longest path
+    path_ends = set()
+    for label in np.nonzero(long_skeletons)[0]:
+        any_pixel = tuple(np.argwhere(labels == label)[0])
+        path_end = farthest_skeleton_pixel(skeleton, any_pixel)
+        path_ends.update((path_end, farthest_skeleton_pixel(skeleton, path_end)))
+
+    # Prune the short end branches; removing a branch may turn its junction into a plain branch pixel, merging the remaining branches, hence the iterations
+    while True:
+        crossing_numbers = skeleton_crossing_numbers(skeleton) * skeleton
+        short_end_branches = []
+        for end_point in map(tuple, np.argwhere(crossing_numbers == 1)):
+            branch = trace_end_branch(skeleton, crossing_numbers, end_point, branch_min_length)
+            if branch is not None and not (branch & path_ends):
+                short_end_branches.append(branch)
+        if not short_end_branches:
+            break
+        for branch in short_end_branches:
+            skeleton[tuple(np.array(list(branch)).T)] = 0
 
-    bfs = list()
+    return skeleton
 
-    bfs.append(tuple(start))
+def get_lv_border_from_segmentation(binary_mask):
+    '''
+    Returns the (112, 112) image of the open lv border (one pixel wide, without its bottom part) of the (112, 112) binary LV mask
+    '''
+    return prune_skeleton(get_open_lv_contour(binary_mask))
 
-    i = 0
+# The 8 neighbours of a pixel, orthogonal ones first: where a one-pixel-wide skeleton turns a corner through both an orthogonal
+# and a diagonal neighbour, stepping to the orthogonal one first keeps the corner pixel on the path
+PATH_STEP_OFFSETS = [(-1, 0), (0, 1), (1, 0), (0, -1), (-1, 1), (1, 1), (1, -1), (-1, -1)]
 
-    # Look all 8 directions for a good path
-    while len(bfs) > 0:
-        if bfs[i] == tuple(end):
-            break
-        x, y = bfs[i]
-        for dy, dx in delta:
-            yy, xx = y + dy, x + dx
-            if k[xx][yy] == 1.0:
-                bfs.append((xx, yy))
-                k[x][y] = 0
-                i = i + 1
-    return np.asarray(bfs)
+def trace_skeleton_path(skeleton, start, end):
+    '''
+    Returns the ordered (npoints, 2) array of the (row, column) points of the one-pixel-wide skeleton, walking it from the point start to the point end.
+    Every pixel is visited at most once, so the walk takes at most as many steps as the skeleton has pixels; the skeleton is not modified.
+    Raises a ValueError if start or end are not on the skeleton, or if the walk reaches a dead end (e.g., a gap or a branch) before end.
+    '''
+    start, end = tuple(int(c) for c in start), tuple(int(c) for c in end)
+    # Pad by a pixel so that the neighbours of the image's border pixels need no bounds checks
+    unvisited = np.pad(np.asarray(skeleton) > 0, 1)
+    for point in (start, end):
+        if not unvisited[point[0]+1, point[1]+1]:
+            raise ValueError("Point " + str(point) + " is not on the skeleton")
+
+    path = [start]
+    row, col = start[0]+1, start[1]+1 # in padded coordinates
+    unvisited[row, col] = False
+    max_steps = int(np.count_nonzero(unvisited))
+    for _ in range(max_steps):
+        if (row-1, col-1) == end:
+            return np.array(path)
+        for dr, dc in PATH_STEP_OFFSETS:
+            if unvisited[row+dr, col+dc]:
+                row, col = row+dr, col+dc
+                break
+        else:
+            raise ValueError("The skeleton path from " + str(start) + " ends at " + str((row-1, col-1)) + " without reaching " + str(end))
+        unvisited[row, col] = False
+        path.append((row-1, col-1))
+    if (row-1, col-1) == end:
+        return np.array(path)
+    raise ValueError("The skeleton path from " + str(start) + " does not reach " + str(end))
 
 def get_path_from_lv_border(lv_borderList):
 
     lv_border_PathList = list()
 
-    i = 0
-
     for lv_border in lv_borderList:
         img_conv = cv2.filter2D((lv_border).astype(np.uint8), -1, np.ones((3, 3)))  #
         img_conv = img_conv * (lv_border)
         img_tips = img_conv == 2
         tips = np.array(np.nonzero(img_tips)).T
+        if len(tips) < 2:
+            raise ValueError("Found " + str(len(tips)) + " end point(s) on the LV border, instead of 2; the border is not an open path")
 
         start, end = tips[1, :], tips[0, :]
 
-        lv_border_PathList.append(findPathBwTwoPoints(lv_border, start, end))
+        lv_border_PathList.append(trace_skeleton_path(lv_border, start, end))
 
     return lv_border_PathList
 
-def tracking_update(lv_border_PathList, vectorFieldList):
-    lv_border = lv_border_PathList[0]
-
-    new_lv_border_path_list = list()
-    new_lv_border_path_list.append(lv_border)
+def tracking_update(lv_border_path, vectorFieldList):
+    '''
+    Tracks the points of lv_border_path (an (npoints, 2) array of (row, column) points on the first frame) across the frames,
+    given the optical flows between every pair of consecutive frames (each of shape (height, width, 2) or (2, height, width), as (x, y) displacements).
+    At every frame all the points are advanced at once, by the flow bilinearly sampled at their sub-pixel positions (points outside the frame take the flow of the nearest border pixel).
+    Returns the (nframes, npoints, 2) array of the tracked points, its first frame being lv_border_path.
+    '''
+    lv_border_path = np.asarray(lv_border_path, dtype=np.float64)
+    tracked_paths = np.empty((len(vectorFieldList) + 1,) + lv_border_path.shape)
+    tracked_paths[0] = lv_border_path
 
-    for vectorFieldTest in vectorFieldList:
+    for i, vectorField in enumerate(vectorFieldList):
         # IF FLOW IS IN (DIRECTION, WIDTH, HEIGHT) SHAPE DO THIS
-        if vectorFieldTest.shape[0] == 2:
-            vectorFieldTest = np.transpose(vectorFieldTest, (1, 2, 0))
-        # vectorFieldTest = np.transpose(vectorFieldTest, (1, 2, 0))
-        pixelDisplacement = []
-        for points in lv_border:
-            x = round(points[0])
-            y = round(points[1])
-            pixelDisplacement.append(vectorFieldTest[x, y, :])
-
-            # IF FLOW IS IN (DIRECTION, WIDTH, HEIGHT) SHAPE DO THIS
-            # pixelDisplacement.append(vectorFieldTest[:, x, y])
-        pixelDisplacement = np.array(pixelDisplacement)
-        x_dis = pixelDisplacement[:, 1]
-        y_dis = pixelDisplacement[:, 0]
-        dis = np.transpose(np.stack((x_dis, y_dis)))
-        lv_border = lv_border + dis
-        new_lv_border_path_list.append(lv_border)
-
-    return new_lv_border_path_list
-
-def measure_strain(lv_border_PathList, ed_frame = 0):
-    lv_borderLengthList = []
-
-    for array in lv_border_PathList:
-        # Fit a smooth spline to the lv_border path and subsample it, and measure the arc length in the subsampled path.
-        # This helps alleviate the slight zigzag pattern that may occur between points as tracking progresses and neighboring points move in slightly different directions.
-        # This zigzag pattern introduces error because it leads to false estimation of the lv_border length (a zigzag path is longer than a straight path).
-        tck, u = splprep(array.T, u=None, s=0.0, per=0)
-        u_new = np.linspace(u.min(), u.max(), 10)
-        new_coords = np.transpose(np.array(splev(u_new, tck, der=0)))
+        if vectorField.shape[0] == 2:
+            vectorField = np.transpose(vectorField, (1, 2, 0))
+        coordinates = tracked_paths[i].T # (2, npoints): the rows and the columns of the points
+        col_displacement = map_coordinates(vectorField[:, :, 0], coordinates, order=1, mode='nearest')
+        row_displacement = map_coordinates(vectorField[:, :, 1], coordinates, order=1, mode='nearest')
+        tracked_paths[i+1] = tracked_paths[i] + np.stack((row_displacement, col_displacement), axis=1)
+
+    return tracked_paths
 
-        lv_borderLengthList.append(cv2.arcLength(curve=new_coords.astype(int), closed=False))
+def interpolate_rows(values, positions):
+    '''
+    Linearly interpolates every row of the (nrows, nvalues) array values at the fractional indices of the matching row of the (nrows, npositions) array positions
+    '''
+    lower = np.clip(np.floor(positions).astype(int), 0, values.shape[1] - 2)
+    fraction = positions - lower
+    lower_values = np.take_along_axis(values, lower, axis=1)
+    upper_values = np.take_along_axis(values, lower + 1, axis=1)
+    return lower_values + fraction * (upper_values - lower_values)
 
-    strain_sequence = []
-    for length in lv_borderLengthList:
-        strain_sequence.append((length - lv_borderLengthList[ed_frame]) / lv_borderLengthList[ed_frame])
+def measure_strain(lv_border_PathList, ed_frame = 0, return_segmental = False):
+    '''
+    Measures the strain of the lv border at every frame, relative to its length at frame ed_frame, given the (nframes, npoints, 2) array of the tracked lv border points.
+    Returns the (nframes,) strain sequence, along with the (nframes, STRAIN_SEGMENTS) segmental strain sequences if return_segmental is True.
+    The segments split the border at evenly spaced (fractional) indices of the tracked points, so each segment follows the same part of the myocardium across the frames.
+    '''
+    lv_border_PathList = np.asarray(lv_border_PathList, dtype=np.float64)
+    nframes, npoints, _ = lv_border_PathList.shape
+
+    # Fit a smooth spline to the lv_border path and subsample it, and measure the arc length in the subsampled path.
+    # This helps alleviate the slight zigzag pattern that may occur between points as tracking progresses and neighboring points move in slightly different directions.
+    # This zigzag pattern introduces error because it leads to false estimation of the lv_border length (a zigzag path is longer than a straight path).
+    samples = np.empty((nframes, STRAIN_SPLINE_SAMPLES, 2))
+    u_bounds = np.empty((nframes, 2))
+    points_u = np.empty((nframes, npoints))
+    for f, array in enumerate(lv_border_PathList):
+        tck, u = splprep(array.T, u=None, s=0.0, per=0)
+        u_bounds[f] = u.min(), u.max()
+        samples[f] = np.transpose(np.array(splev(np.linspace(u.min(), u.max(), STRAIN_SPLINE_SAMPLES), tck, der=0)))
+        points_u[f] = u
+
+    # The (float) lengths along the subsampled paths of all the frames at once
+    sample_distances = np.linalg.norm(np.diff(samples, axis=1), axis=2)
+    cumulative_lengths = np.concatenate((np.zeros((nframes, 1)), np.cumsum(sample_distances, axis=1)), axis=1) # (nframes, STRAIN_SPLINE_SAMPLES)
+    lv_borderLengths = cumulative_lengths[:, -1]
+    strain_sequence = (lv_borderLengths - lv_borderLengths[ed_frame]) / lv_borderLengths[ed_frame]
+    if not return_segmental:
+        return strain_sequence
+
+    # Locate the segments' boundaries on the splines (through the spline parameter of the tracked points), and the path lengths up to them
+    boundary_indices = np.tile(np.linspace(0, npoints - 1, STRAIN_SEGMENTS + 1), (nframes, 1))
+    boundaries_u = interpolate_rows(points_u, boundary_indices)
+    boundary_sample_positions = (boundaries_u - u_bounds[:, :1]) / (u_bounds[:, 1:] - u_bounds[:, :1]) * (STRAIN_SPLINE_SAMPLES - 1)
+    segment_lengths = np.diff(interpolate_rows(cumulative_lengths, boundary_sample_positions), axis=1) # (nframes, STRAIN_SEGMENTS)
+    segmental_strain_sequences = (segment_lengths - segment_lengths[ed_frame]) / segment_lengths[ed_frame]
+
+    return strain_sequence, segmental_strain_sequences
+
+def farneback_optical_flow(frame1, frame2):
+    '''
+    Returns the Farneback optical flow (height, width, 2) from frame1 to frame2
+    '''
+    return cv2.calcOpticalFlowFarneback(prev=frame1, next=frame2, flow=None, **FARNEBACK_PARAMS)
 
-    return strain_sequence
+def farneback_optical_flows(frames, workers=None, pool=None):
+    '''
+    Returns the Farneback optical flows (height, width, 2) between every pair of consecutive frames of the (nframes, height, width) array frames, in order.
+    The frame pairs are independent, so their flows are computed in a pool (pool is 'thread' or 'process', FLOW_POOL by default)
+    of 'workers' workers (FLOW_WORKERS by default); with a single worker, they are computed one after another.
+    '''
+    workers = workers or FLOW_WORKERS or os.cpu_count()
+    pool = pool or FLOW_POOL
+    npairs = len(frames) - 1
+    if workers <= 1 or npairs <= 1:
+        return [farneback_optical_flow(frames[i], frames[i+1]) for i in range(npairs)]
+    if pool == 'thread':
+        executor_class = ThreadPoolExecutor
+    elif pool == 'process':
+        executor_class = ProcessPoolExecutor
+    else:
+        raise ValueError("Unknown optical flow pool: " + str(pool) + ", expected 'thread' or 'process'")
+    with executor_class(max_workers=min(workers, npairs)) as executor:
+        return list(executor.map(farneback_optical_flow, frames[:-1], frames[1:])) # map() yields the flows in the order of the frame pairs
+
+def lucas_kanade_tracking(lv_border_path, frames):
+    '''
+    Tracks the points of lv_border_path (an array of (row, column) points on the first frame) across the (nframes, height, width) array frames
+    with sparse pyramidal Lucas-Kanade optical flow, computed only at the tracked points.
+    Returns the (nframes, npoints, 2) array of the tracked points, like tracking_update().
+    Points the method loses track of (e.g., when they leave the frame) are left in place for that frame pair.
+    '''
+    tracked_paths = np.empty((len(frames),) + np.shape(lv_border_path))
+    tracked_paths[0] = lv_border_path
+    points = np.flip(np.asarray(lv_border_path, dtype=np.float32), axis=1).reshape(-1, 1, 2) # OpenCV expects (x, y) points, so (column, row)
+    for i in range(len(frames) - 1):
+        new_points, status, _ = cv2.calcOpticalFlowPyrLK(np.ascontiguousarray(frames[i]), np.ascontiguousarray(frames[i+1]), np.ascontiguousarray(points), None, **LUCAS_KANADE_PARAMS)
+        lost = status.ravel() == 0
+        new_points[lost] = points[lost]
+        points = new_points
+        tracked_paths[i+1] = np.flip(points.reshape(-1, 2), axis=1)
+    return tracked_paths
+
+def track_lv_border_path(lv_border_path, frames, method=TRACKING_METHOD):
+    '''
+    Tracks the points of lv_border_path (an array of (row, column) points on the first frame) across the (nframes, height, width) array frames
+    with the tracking backend method (one of TRACKING_METHODS).
+    Returns the (nframes, npoints, 2) array of the tracked points, with their coordinates in the frames.
+    '''
+    if method == 'farneback':
+        return tracking_update(lv_border_path, farneback_optical_flows(frames))
+    if method == 'farneback_band':
+        # Compute the flow only within the bounding box of the initial lv border plus a margin, and track the points in the band's coordinates
+        top, left = np.maximum(np.floor(np.min(lv_border_path, axis=0)).astype(int) - TRACKING_BAND_MARGIN, 0)
+        bottom, right = np.minimum(np.ceil(np.max(lv_border_path, axis=0)).astype(int) + TRACKING_BAND_MARGIN + 1, frames.shape[1:3])
+        band_offset = np.array([top, left])
+        band_frames = np.ascontiguousarray(frames[:, top:bottom, left:right])
+        return tracking_update(lv_border_path - band_offset, farneback_optical_flows(band_frames)) + band_offset
+    if method == 'lucas_kanade':
+        return lucas_kanade_tracking(lv_border_path, frames)
+    raise ValueError("Unknown tracking method: " + str(method) + ", expected one of " + str(TRACKING_METHODS))
@@ -0,0 +1,56 @@
+import os
+import threading
+import numpy as np
+import onnxruntime
+
+'''
+Process-wide registry of the ONNX Runtime inference sessions of the estimators' models.
+Every model is loaded (and its graph optimized) once, the first time it is requested or at app start-up through load_models(),
+and its session is then shared by every estimation. InferenceSession.run() is thread-safe, so the Dash worker threads can share sessions.
+'''
+
+# Session options, applied to every session created by the registry (set them before the sessions are created)
+INTRA_OP_NUM_THREADS = 0 # threads used to parallelize the execution within operators; 0 lets ONNX Runtime decide (one per physical core)
+INTER_OP_NUM_THREADS = 0 # threads used to execute independent operators in parallel; 0 lets ONNX Runtime decide
+GRAPH_OPTIMIZATION_LEVEL = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+# The EchoNet models used by the estimators, along with the input shape each one is warmed up with
+ECHONET_MODELS = {
+    'Estimators/LVEF/echonet_segmentation.onnx': (1, 3, 112, 112),
+    'Estimators/LVEF/echonet_pretrained.onnx': (1, 3, 32, 112, 112),
+    'Estimators/LVGLS/echonet_segmentation.onnx': (1, 3, 112, 112),
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(model_path):
+    '''
+    Returns the inference session of the ONNX model at model_path, creating it on the first request
+    '''
+    key = os.path.abspath(model_path)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None: # Another thread may have created it while this one waited for the lock
+                session_options = onnxruntime.SessionOptions()
+                session_options.intra_op_num_threads = INTRA_OP_NUM_THREADS
+                session_options.inter_op_num_threads = INTER_OP_NUM_THREADS
+                session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVEL
+                session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=['CPUExecutionProvider'])
+                _sessions[key] = session
+    return session
+
+def load_models(models=ECHONET_MODELS):
+    '''
+    Loads and warms up (with one inference on an all-zeros input of the given shape) every model of the models dictionary {model_path: input_shape}.
+    Models whose file is missing are skipped, so that they only fail the estimations that use them.
+    '''
+    for model_path, input_shape in models.items():
+        if not os.path.exists(model_path):
+            print("Model", model_path, "not found, skipping its loading")
+            continue
+        session = get_session(model_path)
+        session.run(None, {session.get_inputs()[0].name: np.zeros(input_shape, dtype=np.float32)})
+        print("Model", model_path, "loaded")
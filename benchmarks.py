@@ -0,0 +1,305 @@
+# Import General Packages
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import cv2
+
+# Importing Development Modules
+from utils import resize_video, rgb_to_rgba_volume
+
+"""
+Benchmarks of the app's video processing hot paths against their previous implementations.
+Run with: python benchmarks.py
+"""
+
+
+def synthetic_video(nframes, height, width, seed=0):
+    """
+    Returns a random uint8 video of format (nframes,height,width,3), standing in for a decoded RGB scan
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(nframes, height, width, 3), dtype=np.uint8)
+
+def timed(function, *args, **kwargs):
+    """
+    Calls function with the provided arguments and returns (result, elapsed seconds)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def timed_with_peak_memory(function, *args, **kwargs):
+    """
+    Calls function with the provided arguments and returns (result, elapsed seconds, peak traced memory in bytes)
+    Only allocations made during the call are traced (numpy and OpenCV allocate their arrays through the traced allocator)
+    """
+    tracemalloc.start()
+    try:
+        result, elapsed = timed(function, *args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+### prep_video_for_playback ###
+
+def legacy_prep_video_for_playback(pixel_array_rgb, resize_factor):
+    """
+    The per-pixel implementation of utils.prep_video_for_playback, kept for comparison
+    """
+    def rgb2rgba(rgb, A):
+        rows, cols, ch = rgb.shape
+        rgba = A*np.ones(shape=(rows, cols, 4))
+        for i in range(0, rows):
+            for j in range(0, cols):
+                for k in range(0, 4):
+                    if (k == 3):
+                        continue
+                    rgba[i, j, k] = rgb[i, j, k]
+        return rgba
+
+    video = resize_video(pixel_array_rgb, resize_factor)
+    image_pixels_list = [0]*video.shape[0]
+    for i in range(0, video.shape[0]):
+        image_pixels_list[i] = rgb2rgba(video[i, :, :, :], 255).flatten(order='C')
+    return image_pixels_list
+
+def benchmark_prep_video_for_playback(shapes=((4, 150, 200), (8, 300, 400)), resize_factor=1):
+    """
+    Compares the legacy per-pixel RGBA frame builder with the batched one on synthetic videos
+    Videos are resized up front, so the legacy run only adds an identity resize on top of its per-pixel loop
+    """
+    print("prep_video_for_playback: legacy per-pixel loop vs batched RGBA packing")
+    for nframes, height, width in shapes:
+        video = resize_video(synthetic_video(nframes, height, width), resize_factor)
+        legacy_list, legacy_time = timed(legacy_prep_video_for_playback, video, 1)
+        batched_volume, batched_time = timed(rgb_to_rgba_volume, video, 255)
+        batched_list = list(batched_volume.reshape(nframes, -1))
+        identical = all(np.array_equal(a, b) for a, b in zip(legacy_list, batched_list))
+        print("  (%d,%d,%d,3): legacy %.3fs, batched %.4fs, speedup x%.0f, identical output: %s"
+              % (nframes, height, width, legacy_time, batched_time, legacy_time/max(batched_time, 1e-9), identical))
+
+### resize_video ###
+
+def legacy_resize_video(video, factor):
+    """
+    The per-frame, float64 implementation of utils.resize_video, kept for comparison
+    """
+    nframes = video.shape[0]
+    new_height = int(video.shape[1]/factor)
+    new_width = int(video.shape[2]/factor)
+    channels = video.shape[3]
+
+    video_resized = np.zeros((nframes, new_height, new_width, channels))
+    for frame in range(0, nframes):
+        image = video[frame, :, :, :]
+        image_resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+        video_resized[frame, :, :, :] = image_resized
+    return video_resized
+
+def benchmark_resize_video(shapes=((90, 600, 800), (180, 600, 800)), resize_factor=2):
+    """
+    Compares the legacy per-frame float64 resize with the batched uint8 one (single-threaded and thread-pooled)
+    in time and peak memory, on synthetic videos
+    """
+    print("resize_video: legacy per-frame float64 vs batched uint8 (factor %s)" % resize_factor)
+    for nframes, height, width in shapes:
+        video = synthetic_video(nframes, height, width)
+        legacy_video, legacy_time, legacy_peak = timed_with_peak_memory(legacy_resize_video, video, resize_factor)
+        print("  (%d,%d,%d,3): legacy %.3fs, peak %.1f MB" % (nframes, height, width, legacy_time, legacy_peak/1024**2))
+        for workers in (1, os.cpu_count()):
+            batched_video, batched_time, batched_peak = timed_with_peak_memory(resize_video, video, resize_factor, workers=workers)
+            max_difference = np.max(np.abs(batched_video.astype(np.float64) - legacy_video))
+            print("    batched, %d worker(s): %.3fs, peak %.1f MB, max abs difference from legacy: %s"
+                  % (workers, batched_time, batched_peak/1024**2, max_difference))
+
+### LVGLS optical flow ###
+
+def benchmark_lvgls_optical_flow(nframes=40, side=568):
+    """
+    Compares the sequential computation of the Farneback optical flows of the LVGLS pipeline with the thread and process pools,
+    on a synthetic (nframes,side,side) scan of a smooth pattern drifting across the frames
+    """
+    from Estimators.LVGLS.lvgls_pipeline_functions import farneback_optical_flows # Imported here, as it loads the estimators' dependencies
+
+    pattern = cv2.GaussianBlur(synthetic_video(1, side + nframes, side + nframes)[0, :, :, 0], (0, 0), 5)
+    frames = np.stack([pattern[i:i+side, i:i+side] for i in range(nframes)])
+    print("LVGLS optical flow: sequential vs pooled, %d frame pairs of %dx%d" % (nframes - 1, side, side))
+    sequential_flows, sequential_time = timed(farneback_optical_flows, frames, workers=1)
+    print("  sequential: %.3fs" % sequential_time)
+    for pool in ('thread', 'process'):
+        for workers in sorted({2, os.cpu_count()}):
+            pooled_flows, pooled_time = timed(farneback_optical_flows, frames, workers=workers, pool=pool)
+            identical = all(np.array_equal(a, b) for a, b in zip(sequential_flows, pooled_flows))
+            print("  %s pool, %d workers: %.3fs, speedup x%.1f, identical output: %s"
+                  % (pool, workers, pooled_time, sequential_time/max(pooled_time, 1e-9), identical))
+
+### LVGLS skeleton pruning ###
+
+def synthetic_lv_masks(nmasks, seed=0):
+    """
+    Returns nmasks random (112,112) uint8 masks roughly shaped like the LV segmentations of the LVGLS pipeline:
+    an ellipse with a few bumps along its border (so that its contour has branches to prune), cut flat at the base and median-blurred
+    """
+    rng = np.random.default_rng(seed)
+    masks = []
+    for _ in range(nmasks):
+        mask = np.zeros((112, 112), dtype=np.uint8)
+        cv2.ellipse(mask, (56, 60), (int(rng.integers(15, 25)), int(rng.integers(30, 40))), float(rng.integers(-20, 20)), 0, 360, 1, -1)
+        for _ in range(4):
+            cv2.circle(mask, (int(rng.integers(35, 78)), int(rng.integers(30, 80))), int(rng.integers(2, 6)), 1, -1)
+        mask[85:, :] = 0
+        masks.append(cv2.medianBlur(mask, 13))
+    return masks
+
+def legacy_prune_skeleton(binary_image):
+    """
+    The FilFinder2D skeleton pruning that get_lv_border_from_segmentation used, kept for comparison (requires astropy and fil_finder)
+    """
+    import astropy.units as u
+    from fil_finder import FilFinder2D
+
+    fil = FilFinder2D(binary_image, distance=250 * u.pc, mask=binary_image)
+    fil.preprocess_image(flatten_percent=85)
+    fil.create_mask(border_masking=True, verbose=False, use_existing_mask=True)
+    fil.medskel(verbose=False)
+    fil.analyze_skeletons(branch_thresh=40 * u.pix, skel_thresh=40 * u.pix, prune_criteria='length')
+    return np.array(fil.skeleton)
+
+def benchmark_skeleton_pruning(nmasks=50):
+    """
+    Regression check and timing comparison of the native skeleton pruner of the LVGLS pipeline against FilFinder2D,
+    on the open contours of synthetic LV masks: reports how many pruned borders are identical, the largest pixel difference, and the time per border
+    """
+    from Estimators.LVGLS.lvgls_pipeline_functions import get_open_lv_contour, prune_skeleton # Imported here, as it loads the estimators' dependencies
+
+    print("LV border skeleton pruning: FilFinder2D vs native, %d synthetic masks" % nmasks)
+    contours = [get_open_lv_contour(mask) for mask in synthetic_lv_masks(nmasks)]
+    legacy_borders, legacy_time = timed(lambda: [legacy_prune_skeleton(contour) for contour in contours])
+    native_borders, native_time = timed(lambda: [prune_skeleton(contour) for contour in contours])
+    differences = [int(np.sum((legacy > 0) != (native > 0))) for legacy, native in zip(legacy_borders, native_borders)]
+    print("  FilFinder2D %.2fms/border, native %.2fms/border, speedup x%.0f"
+          % (1000*legacy_time/nmasks, 1000*native_time/nmasks, legacy_time/max(native_time, 1e-9)))
+    print("  identical borders: %d/%d, max differing pixels: %d" % (differences.count(0), nmasks, max(differences)))
+
+### LVGLS border path tracing ###
+
+def legacy_find_path_between_two_points(k, start, end):
+    """
+    The list-as-queue path walk (findPathBwTwoPoints) that get_path_from_lv_border used, kept for comparison; it clears the pixels of k it walks
+    """
+    delta = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+    bfs = [tuple(start)]
+    i = 0
+    while len(bfs) > 0:
+        if bfs[i] == tuple(end):
+            break
+        x, y = bfs[i]
+        for dy, dx in delta:
+            yy, xx = y + dy, x + dx
+            if k[xx][yy] == 1.0:
+                bfs.append((xx, yy))
+                k[x][y] = 0
+                i = i + 1
+    return np.asarray(bfs)
+
+def synthetic_lv_border_skeletons(nskeletons, side=568, seed=0):
+    """
+    Returns nskeletons random (side,side) uint8 one-pixel-wide open arcs, like the lv border skeletons traced by the LVGLS pipeline, along with their two end points
+    """
+    from skimage.morphology import skeletonize
+
+    rng = np.random.default_rng(seed)
+    skeletons = []
+    for _ in range(nskeletons):
+        skeleton = np.zeros((side, side), dtype=np.uint8)
+        axes = (int(rng.integers(side//8, side//4)), int(rng.integers(side//4, side//3)))
+        cv2.ellipse(skeleton, (side//2, side//2), axes, float(rng.integers(-20, 20)), int(rng.integers(100, 130)), int(rng.integers(410, 440)), 1, thickness=1)
+        skeleton = skeletonize(skeleton > 0, method='lee').astype(np.uint8)
+        neighbour_counts = cv2.filter2D(skeleton, -1, np.ones((3, 3))) * skeleton
+        tips = np.argwhere(neighbour_counts == 2)
+        skeletons.append((skeleton, tips[1], tips[0]))
+    return skeletons
+
+def benchmark_trace_skeleton_path(nskeletons=50, side=568):
+    """
+    Compares the legacy list-as-queue border walk with trace_skeleton_path on synthetic (side,side) border skeletons
+    """
+    from Estimators.LVGLS.lvgls_pipeline_functions import trace_skeleton_path # Imported here, as it loads the estimators' dependencies
+
+    print("LV border path tracing: legacy walk vs trace_skeleton_path, %d skeletons of %dx%d" % (nskeletons, side, side))
+    skeletons = synthetic_lv_border_skeletons(nskeletons, side)
+    legacy_paths, legacy_time = timed(lambda: [legacy_find_path_between_two_points(skeleton.copy(), start, end) for skeleton, start, end in skeletons])
+    paths, time_ = timed(lambda: [trace_skeleton_path(skeleton, start, end) for skeleton, start, end in skeletons])
+    identical = sum(np.array_equal(legacy_path, path) for legacy_path, path in zip(legacy_paths, paths))
+    print("  legacy %.3fms/path, trace_skeleton_path %.3fms/path, speedup x%.1f, identical paths: %d/%d (%.0f points per path on average)"
+          % (1000*legacy_time/nskeletons, 1000*time_/nskeletons, legacy_time/max(time_, 1e-9), identical, nskeletons, np.mean([len(path) for path in paths])))
+
+### LVGLS tracking ###
+
+def benchmark_lvgls_tracking(dicom_paths, methods=('farneback', 'farneback_band', 'lucas_kanade')):
+    """
+    Runs the LVGLS pipeline on the recorded scans dicom_paths with every tracking backend, and compares each backend
+    with the reference (the first one) in run time and in agreement of the strain sequence and of the LVGLS
+    Requires the LVGLS segmentation model (run from the app's directory, with the estimators in ./Estimators)
+    """
+    from Estimators.LVGLS.estimate_lvgls import estimate_lv_strain_from_DICOM_file # Imported here, as it loads the estimators' dependencies
+
+    print("LVGLS tracking backends: %s vs %s" % (methods[0], ", ".join(methods[1:])))
+    for dicom_path in dicom_paths:
+        print("  " + os.path.basename(dicom_path))
+        reference_strain = None
+        for method in methods:
+            (strain_sequence, _), elapsed = timed(estimate_lv_strain_from_DICOM_file, dicom_path, tracking_method=method)
+            strain_sequence = np.asarray(strain_sequence)
+            lvgls = np.nanmin(strain_sequence)*100
+            if reference_strain is None:
+                reference_strain, reference_lvgls, reference_time = strain_sequence, lvgls, elapsed
+                print("    %s: %.3fs, LVGLS %.2f%%" % (method, elapsed, lvgls))
+                continue
+            max_difference = np.nanmax(np.abs(strain_sequence - reference_strain))*100
+            print("    %s: %.3fs (speedup x%.1f), LVGLS %.2f%% (difference %.2f), max strain difference %.2f percentage points"
+                  % (method, elapsed, reference_time/max(elapsed, 1e-9), lvgls, lvgls - reference_lvgls, max_difference))
+
+def check_cardiac_cycle_probe(framerate=50):
+    """
+    Checks that the incremental LVGLS cardiac cycle detection's probe reports no confirmed cycle (instead of failing)
+    on LV area sequences where no cycle can be detected: a too short, a flat and a V-shaped (peak-less) one
+    """
+    from Estimators.LVGLS.estimate_lvgls import cardiac_cycle_confirmed, CYCLE_DETECTION_MIN_SECONDS # Imported here, as it loads the estimators' dependencies
+
+    nframes = int(2*CYCLE_DETECTION_MIN_SECONDS*framerate)
+    sequences = {
+        'too short': 1000 + 100*np.sin(np.linspace(0, 4*np.pi, int(CYCLE_DETECTION_MIN_SECONDS*framerate) - 1)),
+        'flat': np.full(nframes, 1000.0),
+        'V-shaped': 1000 + np.abs(np.linspace(-100, 100, nframes)),
+    }
+    print("Cardiac cycle probe on undetectable LV area sequences")
+    for name, sequence in sequences.items():
+        confirmed = cardiac_cycle_confirmed(sequence, framerate)
+        print("  %s: %s" % (name, "not confirmed (ok)" if not confirmed else "CONFIRMED (unexpected)"))
+        assert not confirmed, "a cardiac cycle was confirmed on the " + name + " LV area sequence"
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'playback': benchmark_prep_video_for_playback,
+        'resize': benchmark_resize_video,
+        'lvgls_flow': benchmark_lvgls_optical_flow,
+        'skeleton_pruning': benchmark_skeleton_pruning,
+        'path_tracing': benchmark_trace_skeleton_path,
+        'cycle_probe': check_cardiac_cycle_probe,
+    }
+    # Benchmarks on recorded scans take the paths of the DICOM files after their name, e.g.: python benchmarks.py lvgls_tracking scan1.dcm scan2.dcm
+    recorded_scan_benchmarks = {
+        'lvgls_tracking': benchmark_lvgls_tracking,
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in recorded_scan_benchmarks:
+        recorded_scan_benchmarks[sys.argv[1]](sys.argv[2:])
+    else:
+        selected = sys.argv[1:] or list(benchmarks)
+        for name in selected:
+            benchmarks[name]()
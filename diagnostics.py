@@ -0,0 +1,76 @@
+# Import General Packages
+import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+
+"""
+Diagnostics of the estimators, saved as plots in the user's session directory (./Sessions/<username>/Diagnostics/).
+The estimators accept an optional diagnostics_hook(name, data) and call it with the intermediate results worth inspecting;
+session_diagnostics_hook() returns such a hook, which plots and saves them in a background thread, off the request's path.
+Diagnostics are only collected when the app runs with the ECHO_DIAGNOSTICS environment variable set (e.g. ECHO_DIAGNOSTICS=1);
+otherwise no hook is passed to the estimators, which then skip them altogether.
+"""
+
+DIAGNOSTICS_ENABLED = os.environ.get('ECHO_DIAGNOSTICS', '') not in ('', '0')
+
+# A single writer thread, so that plotting never competes with the estimations for more than one core
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diagnostics')
+_counter_lock = threading.Lock()
+_counter = 0
+
+
+def plot_cardiac_cycle_detection(figure, endo_areas_sequence, endo_areas_filtered, cardiac_cycle_frames,
+                                 max_half_cycle_length, mean_half_cycle_length, endo_areas_mean, endo_areas_filtered_mean):
+    """
+    Plots the LV area signal of the LVGLS cardiac cycle detection, its filtered version and the detected cycle
+    """
+    ax = figure.subplots()
+    ax.plot(endo_areas_sequence, label='LV area')
+    ax.plot(cardiac_cycle_frames, endo_areas_sequence[cardiac_cycle_frames], 'o', label='Detected cycle')
+    ax.plot(max_half_cycle_length, endo_areas_mean, '*', label='Max half cycle length')
+    ax.plot(mean_half_cycle_length, endo_areas_mean, 'x', label='Mean half cycle length')
+    ax.plot(endo_areas_filtered + endo_areas_mean, label='Filtered LV area')
+    ax.axhline(endo_areas_filtered_mean)
+    ax.set_xlabel('Frame')
+    ax.legend(fontsize='small')
+
+# The plotting function of every diagnostic the estimators report, by name
+DIAGNOSTIC_PLOTS = {
+    'cardiac_cycle_detection': plot_cardiac_cycle_detection,
+}
+
+
+def save_diagnostic_plot(diagnostics_dir, filename, name, data):
+    """
+    Plots the diagnostic name with its data and saves it as diagnostics_dir/filename
+    Figures are created through matplotlib's object-oriented API, not pyplot, so they are not kept in pyplot's global
+    state (nor need closing) and can be drawn outside the main thread
+    """
+    try:
+        figure = Figure(figsize=(8, 4.5))
+        DIAGNOSTIC_PLOTS[name](figure, **data)
+        os.makedirs(diagnostics_dir, exist_ok=True)
+        figure.savefig(os.path.join(diagnostics_dir, filename))
+    except Exception as e:
+        print("Could not save diagnostic", name, ":", str(e))
+
+def session_diagnostics_hook(username, label=''):
+    """
+    Returns a diagnostics_hook(name, data) for the estimators, which saves the reported diagnostics as PNG plots in the
+    user's Diagnostics directory, named after the time, the label (e.g. the scan's filename) and the diagnostic.
+    The plots are drawn and written asynchronously, by the diagnostics writer thread.
+    """
+    diagnostics_dir = './Sessions/' + username + '/Diagnostics'
+    def diagnostics_hook(name, data):
+        global _counter
+        if name not in DIAGNOSTIC_PLOTS:
+            return
+        with _counter_lock:
+            _counter += 1
+            counter = _counter
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = '_'.join(part for part in (timestamp, str(counter), label, name) if part) + '.png'
+        _writer.submit(save_diagnostic_plot, diagnostics_dir, filename, name, data)
+    return diagnostics_hook
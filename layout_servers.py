@@ -1,11 +1,9 @@
 # Import General Packages
 from dash import html,dcc,dash_table
-import pydicom
 import datetime
-from flask import request
 # Importing Development Modules
 import cvp
-from utils import get_estimations_dict, load_session
+from utils import get_estimations_dict, get_scan_frame_counts, load_session
 
 header_color = '#02072F' # dark blue
 background_color = '#28282B' # matte black
@@ -13,6 +11,7 @@ text_color = 'white'
 thumbnail_button_color = 'gold'
 window_background_color = '#28282B' # matte black
 text_fond = ["Product Sans"]
+LVGLS_MIN_FRAMES = 62 # scans with fewer frames are too short for the LVGLS estimation, which needs several cardiac cycles
 
 """
 NOTE: For a lot of components, extra styling options other than height and width are taken care of in the css file in the assets folder
@@ -520,12 +519,15 @@ def serve_patient_info_window_children():
     return window_children
 
 
-def serve_LVEF_results_window(lvef_estimation, masked_video_cvp, execution_time):
+def serve_LVEF_results_window(lvef_estimation, masked_video_cvp, execution_time, lvef_spread=None):
     """
-    Given the LVEF estimation and the masked video player, this function
-    returns the children and style properties of the hidden_div,
+    Given the LVEF estimation (and optionally its spread across the estimated clips) and the masked video player,
+    this function returns the children and style properties of the hidden_div,
     so that the results of the estimation are displayed to the user
     """
+    lvef_text = "LVEF: " + str(round(lvef_estimation,1)) +"%"
+    if (lvef_spread is not None):
+        lvef_text = lvef_text + " \u00B1 " + str(round(lvef_spread,1)) + "%"
     window_children = [
         # Header
         html.Header([
@@ -540,7 +542,7 @@ def serve_LVEF_results_window(lvef_estimation, masked_video_cvp, execution_time)
         html.Div(
             [
                 html.H3(
-                    "LVEF: " + str(round(lvef_estimation,1)) +"%",
+                    lvef_text,
                     id = {"type":"estimation_result_window","index":"estimaton_value"},
                     style={'width': '95%','height':'5%', 'textAlign':'center','verticalAlign':'top',
                     'margin':'0% 2.5%','padding':'0%'}
@@ -602,24 +604,20 @@ def serve_LVEF_results_window(lvef_estimation, masked_video_cvp, execution_time)
 def create_scan_selection_buttons(scan_thumbnails,estimation_type):
     """
     For every thumbnail in the thumbnail area, create the corresponding scan selection button and return them as a list
-    To be used in serve_LVEF_selection_window()
+    To be used in serve_LVEF_selection_window() and serve_LVGLS_selection()
+    Scans of less than LVGLS_MIN_FRAMES frames are not listed for the LVGLS estimation (their frame count is read from the session manifest)
     """
-    username = request.authorization['username']
-    filepath = './Sessions/' + username + '/Dicoms/'
-
+    if (estimation_type == 'LVGLS'):
+        scan_frame_counts = get_scan_frame_counts()
     scan_selection = []
     # For every thumbnail in the thumbnail area, create the corresponding scan selection button
     for thumbnail in scan_thumbnails:
         image_src = thumbnail['props']['children'][0]['props']['children']['props']['src']
         scan_index = thumbnail['props']['children'][0]['props']['id']['index']
         scan_text = thumbnail['props']['children'][1]['props']['children']
-
-        filename = scan_text.split(":")[0]
-        ds = pydicom.dcmread(filepath+filename)
-        if (ds.pixel_array.shape[0] < 62):
-            # If the current scan's nframes is <62, do not list it as available for the LVEF estimation
+        if (estimation_type == 'LVGLS' and scan_frame_counts.get(str(scan_index), 0) < LVGLS_MIN_FRAMES):
             continue
-    
+
         image_button = html.Div([
             html.Button(
                 html.Img(src=image_src, style={
@@ -641,8 +639,6 @@ def create_scan_selection_buttons(scan_thumbnails,estimation_type):
 def serve_LVEF_selection_window(scan_thumbnails_children):
     """
     Returns the children and the style of the LVEF scan selection window
-    NOTE: Scans with nframes<62 are not shown as an option for the LVEF estimation,
-    due to the current LVEF pipelines' inability to deal with them
     """
     scan_selection = create_scan_selection_buttons(scan_thumbnails_children,'LVEF')
 
@@ -664,15 +660,11 @@ def serve_LVEF_selection_window(scan_thumbnails_children):
             [
             html.H2(
                 "Choose the scan to perform the LVEF estimation on",
-                style={'width': '100%', 'height': '7%', 'margin': '0%', 'textAlign': 'center', 'verticalAlign': 'top', 'display':'inline-block','color':text_color}
-            ),
-            html.H3(
-                "Scans with less than 62 frames are currently not suitable for the LVEF estimation and are thus not shown",
-                style={'width':'100%','height':'5%','color':text_color,'textAlign':'center','margin': '0px', 'padding': '0px'}
+                style={'width': '100%', 'height': '10%', 'margin': '0%', 'textAlign': 'center', 'verticalAlign': 'top', 'display':'inline-block','color':text_color}
             ),
             html.Div(
                 scan_selection,
-                style={'width': '98%', 'height': '86%', 'backgroundColor': 'black',
+                style={'width': '98%', 'height': '88%', 'backgroundColor': 'black',
                    'margin': '0% 1%', 'padding': '0%', 'overflow': 'auto', 'direction': 'ltr'}
             )
             ],
@@ -994,13 +986,13 @@ def serve_study_overview_window():
     return (window_children,window_style)
 
 
-def serve_scan_thumbnail(img_b64, thumbnail_index, text):
+def serve_scan_thumbnail(img_src, thumbnail_index, text):
     """
-    Given the base-64 byte representation of the image, it's index and the text, this function creates the corresponding thumbnail
+    Given the image's source (its base-64 data URI or the URL it is served at), it's index and the text, this function creates the corresponding thumbnail
     """
     scan_thumbnail = html.Div([
         html.Button(
-            html.Img(src=img_b64, style={'width': '100%', 'height': '100%'}),
+            html.Img(src=img_src, style={'width': '100%', 'height': '100%'}),
             style={'width': '100%', 'height': '90%'}, id={'type': 'scan_playbutton', 'index': str(thumbnail_index)}
         ),
         html.H4(text, style={'margin': '0%', 'direction': 'ltr','color':thumbnail_button_color}),
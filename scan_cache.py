@@ -0,0 +1,143 @@
+# Import General Packages
+import threading
+from collections import OrderedDict
+import pydicom
+from pydicom.pixel_data_handlers.util import convert_color_space
+
+"""
+In-process caches of decoded scans, of their headers, of their LVEF estimations and of their prepared playback frames,
+so that re-opening or re-estimating a scan does not re-read and re-decode its DICOM file.
+The caches are shared by all users (hence the username in every key) and all Dash worker threads.
+"""
+
+# Memory budgets of the caches below, in bytes
+DECODED_SCANS_MAX_BYTES = 1024**3 # 1 GB, about eight 90-frame 600x800 scans
+PLAYBACK_FRAMES_MAX_BYTES = 512*1024**2 # 512 MB
+LVEF_ESTIMATIONS_MAX_BYTES = 512*1024**2 # 512 MB, a 64-frame 600x800 mask overlay takes about 130 MB
+SCAN_HEADERS_MAX_BYTES = 64*1024**2 # 64 MB
+SCAN_HEADER_NBYTES = 16*1024 # the (estimated) footprint of a header without its pixel data, a few KB of elements
+
+
+def value_nbytes(value):
+    """
+    Returns the memory footprint of a cached value, counting only its headers and the values that report their
+    nbytes (numpy arrays, decoded scans, mask overlays), nested in lists and tuples, which dominate the size of everything cached here
+    """
+    if isinstance(value, pydicom.Dataset):
+        return SCAN_HEADER_NBYTES
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+class DecodedScan:
+    """
+    The decoded pixel array of a scan, in its native color space (photometric_interpretation, YBR_FULL for the scans
+    the app receives), along with a lazily converted RGB view of it.
+    The estimators take the native array and get its luma (Y) plane directly, while the RGB view is only computed
+    (once) for displaying the scan. Both arrays are read-only, as they are shared by every caller.
+    """
+
+    def __init__(self, pixel_array, photometric_interpretation):
+        pixel_array.flags.writeable = False
+        self.pixel_array = pixel_array
+        self.photometric_interpretation = photometric_interpretation
+        self._rgb = None
+        self._rgb_lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """
+        The memory footprint of the scan, including its RGB view (whether or not it has been computed yet)
+        """
+        copies = 1 if self.photometric_interpretation == 'RGB' else 2
+        return copies * self.pixel_array.nbytes
+
+    @property
+    def rgb(self):
+        """
+        The scan converted to RGB, of format (nframes,height,width,3)
+        """
+        if self._rgb is None:
+            with self._rgb_lock:
+                if self._rgb is None: # Another thread may have converted it while this one waited for the lock
+                    rgb = convert_color_space(self.pixel_array, self.photometric_interpretation, 'RGB')
+                    rgb.flags.writeable = False
+                    self._rgb = rgb
+        return self._rgb
+
+
+class LRUCache:
+    """
+    A thread-safe cache that evicts its least recently used entries once the
+    total size of its values exceeds max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict() # key -> (value, nbytes), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached under key (marking it as the most recently used) or default if there is none
+        """
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        """
+        Caches value under key, evicting least recently used entries as needed to stay within the memory budget.
+        Values larger than the entire budget are not cached.
+        """
+        nbytes = value_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            while self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_nbytes
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+
+    def invalidate(self, *key_prefix):
+        """
+        Drops every entry whose (tuple) key starts with key_prefix
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[:len(key_prefix)] == key_prefix]:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+# DecodedScan's, keyed by (username, filename)
+decoded_scans = LRUCache(DECODED_SCANS_MAX_BYTES)
+# Headers (Datasets read without their pixel data), keyed by (username, filename)
+scan_headers = LRUCache(SCAN_HEADERS_MAX_BYTES)
+# LVEF estimations (LVEF, spread, MaskOverlay, execution time), keyed by (username, filename), so that changing the
+# mask display mode only renders the overlay again
+lvef_estimations = LRUCache(LVEF_ESTIMATIONS_MAX_BYTES)
+# imagePixelsList's ready to be served to a cornerstoneVP, keyed by (username, filename, resize percentage, mask mode)
+# The mask mode is None for the unmasked scan
+playback_frames = LRUCache(PLAYBACK_FRAMES_MAX_BYTES)
+
+
+def invalidate_scan(username, filename=None):
+    """
+    Drops the cached data of the user's scan filename, or of all of the user's scans if filename is None
+    """
+    key_prefix = (username,) if filename is None else (username, filename)
+    decoded_scans.invalidate(*key_prefix)
+    scan_headers.invalidate(*key_prefix)
+    lvef_estimations.invalidate(*key_prefix)
+    playback_frames.invalidate(*key_prefix)
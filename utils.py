@@ -4,16 +4,18 @@ import time
 import cv2
 import base64
 import datetime
+import hashlib
 import io
 import json
 import pydicom
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from flask import request
 from pydicom.pixel_data_handlers.util import convert_color_space
 from dash.exceptions import PreventUpdate
-import matplotlib
-matplotlib.use('Agg')  # non-GUI backend to avoid annoying warning message
-import matplotlib.pylab as plt
+# Importing Development Modules
+from scan_cache import DecodedScan, decoded_scans, invalidate_scan, scan_headers
 
 
 
@@ -21,23 +23,44 @@ import matplotlib.pylab as plt
 ### Utility Functions ###
 # General utility functions
 
-def resize_video(video, factor):
+RESIZE_MAX_CHANNELS = 512 # the maximum number of channels of an image OpenCV can resize in one call (CV_CN_MAX)
+RESIZE_THREADPOOL_MIN_BYTES = 64*1024**2 # videos larger than this are resized by a thread pool
+
+def resize_video(video, factor, workers=None):
     """
-    Resizes the video of format (nframes,height,width,3) to (nframes,height/factor,width/factor,3)
+    Resizes the video of format (nframes,height,width,3) to (nframes,height/factor,width/factor,3), keeping its dtype
+    The video is only copied if its size would not change, so the result never aliases the input (e.g. a cached, read-only scan).
+
+    Instead of one cv2.resize call per frame, frames are stacked along the channel axis and resized in batches of up
+    to RESIZE_MAX_CHANNELS channels. Videos larger than RESIZE_THREADPOOL_MIN_BYTES have their batches split among
+    a pool of 'workers' threads (defaults to the number of CPUs), as OpenCV releases the GIL while resizing.
     """
     #print("resize_video called to resize ",video.shape," to (",video.shape[1]/factor,",",video.shape[2]/factor,")",sep="")
-    nframes = video.shape[0]
-    new_height = int(video.shape[1]/factor)
-    new_width = int(video.shape[2]/factor)
-    channels = video.shape[3]
-
-    video_resized = np.zeros((nframes, new_height, new_width, channels))
-    for frame in range(0, nframes):
-        #print("At frame",frame,"of",nframes)
-        image = video[frame, :, :, :]
-        image_resized = cv2.resize(image, (new_width, new_height),  # fx=factor,fy=factor,
-                                   interpolation=cv2.INTER_CUBIC)
-        video_resized[frame, :, :, :] = image_resized
+    nframes, height, width, channels = video.shape
+    new_height = int(height/factor)
+    new_width = int(width/factor)
+    if (new_height == height and new_width == width):
+        return video.copy()
+
+    if (workers is None):
+        workers = os.cpu_count() if video.nbytes > RESIZE_THREADPOOL_MIN_BYTES else 1
+    frames_per_batch = max(1, min(RESIZE_MAX_CHANNELS // channels, -(-nframes // workers)))
+
+    video_resized = np.empty((nframes, new_height, new_width, channels), dtype=video.dtype)
+    def resize_batch(start):
+        stop = min(start + frames_per_batch, nframes)
+        # (batch,height,width,channels) -> (height,width,batch*channels), the layout cv2.resize expects
+        stacked_frames = video[start:stop].transpose((1, 2, 0, 3)).reshape((height, width, -1))
+        stacked_resized = cv2.resize(stacked_frames, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+        video_resized[start:stop] = stacked_resized.reshape((new_height, new_width, stop - start, channels)).transpose((2, 0, 1, 3))
+
+    batch_starts = range(0, nframes, frames_per_batch)
+    if (workers > 1 and len(batch_starts) > 1):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(resize_batch, batch_starts)) # list() to re-raise any exception of the workers
+    else:
+        for start in batch_starts:
+            resize_batch(start)
     return video_resized
 
 def extract_type_index(str_dict):
@@ -100,53 +123,156 @@ def create_study_summary(patient_general_info, patient_background_info, patient_
 
     return summary
 
-def prep_video_for_playback(pixel_array_rgb,resize_factor):
+def rgb_to_rgba_volume(video_rgb, alpha=255):
+    """
+    Packs a video of format (nframes,height,width,3) into a uint8 RGBA volume
+    of format (nframes,height,width,4), with the opacity channel set to alpha
+    """
+    nframes, height, width, _ = video_rgb.shape
+    video_rgba = np.empty((nframes, height, width, 4), dtype=np.uint8)
+    # A single (casting) copy of all frames' colour channels and a single fill of the opacity channel
+    np.copyto(video_rgba[:, :, :, :3], video_rgb, casting='unsafe')
+    video_rgba[:, :, :, 3] = alpha
+    return video_rgba
+
+def prep_video_for_playback(pixel_array_rgb,resize_factor,draw_overlay=None):
     """
-    Converts pixel_array_rgb to a list of flattened 1-D arrays 
+    Converts pixel_array_rgb to a list of flattened 1-D arrays
     after resizing the video and adding an opacity channel
+    draw_overlay(video), if provided, draws an overlay in place on the resized (nframes,height,width,4) video,
+    i.e. at the playback resolution
 
     Returns the imagePixelsList
     """
-    
-    def rgb2rgba(rgb, A):
-        # Transforms an RGB picture into an RGBA one (adds opacity channel)
-        rows, cols, ch = rgb.shape
-        rgba = A*np.ones(shape=(rows, cols, 4))
-        for i in range(0, rows):
-            for j in range(0, cols):
-                for k in range(0, 4):
-                    if (k == 3):
-                        continue
-                    rgba[i, j, k] = rgb[i, j, k]
-        return rgba
-
     processing_start = time.time()
     rgb_resized = resize_video(pixel_array_rgb, resize_factor)
     # print("rgb_resized:",rgb_resized.shape)
 
-    # rgb/rgb_short all are (nframes,height,width,channels)
-    video = rgb_resized
-    image_pixels_list = [0]*video.shape[0]
-    for i in range(0, video.shape[0]):
-        rgbPic = video[i, :, :, :]
-        rgbaPic = rgb2rgba(rgbPic, 255)
-        flat_rgbaPic = rgbaPic.flatten(order='C')
-        image_pixels_list[i] = flat_rgbaPic
+    # rgb_resized is (nframes,height,width,channels), video is (nframes,height,width,4)
+    video = rgb_to_rgba_volume(rgb_resized, 255)
+    if (draw_overlay is not None):
+        draw_overlay(video)
+    # Each entry is a (flattened, C-order) view of one frame of the packed volume, no per-frame copies
+    image_pixels_list = list(video.reshape(video.shape[0], -1))
     processing_end = time.time()
     processing_time = processing_end-processing_start
     print("Video processing time: ", processing_time)
     return(image_pixels_list)
 
+def encode_frame(frame_rgb, image_format='png'):
+    """
+    Encodes a single (height,width,3) RGB frame as a compressed image of the given format
+    ('png' or 'webp', the latter being lossless at quality 101) and returns the image's bytes
+    """
+    if (image_format == 'png'):
+        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 1] # low compression level, most of the gain is had at level 1 and it encodes fastest
+    elif (image_format == 'webp'):
+        encode_params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        raise ValueError("Unsupported playback frame format: " + str(image_format))
+
+    # OpenCV encodes BGR images
+    frame_bgr = cv2.cvtColor(frame_rgb.astype(np.uint8, copy=False), cv2.COLOR_RGB2BGR)
+    success, frame_bytes = cv2.imencode('.' + image_format, frame_bgr, encode_params)
+    if (not success):
+        raise ValueError("Frame could not be encoded as " + image_format)
+    return frame_bytes.tobytes()
+
+def encode_playback_frames(video_rgb, image_format='png'):
+    """
+    Encodes every frame of the video of format (nframes,height,width,3) with encode_frame()
+
+    Returns a list of the base-64 strings of the encoded frames
+    """
+    encoded_frames = [0]*video_rgb.shape[0]
+    for i in range(0, video_rgb.shape[0]):
+        encoded_frames[i] = base64.b64encode(encode_frame(video_rgb[i], image_format)).decode()
+    return encoded_frames
+
+THUMBNAIL_WIDTH = 320 # the width (in pixels) scan thumbnails are downscaled to, about the size they are displayed at
+THUMBNAIL_JPEG_QUALITY = 85
+
+def make_thumbnail(first_frame, photometric_interpretation="YBR_FULL"):
+    """
+    Downscales the given first frame of a scan, in its native color space (photometric_interpretation), to THUMBNAIL_WIDTH
+    with OpenCV and encodes it as a JPEG
+
+    Returns the thumbnail's bytes
+    """
+    if (first_frame.ndim != 3):
+        print("Error, first frame shape not accepted/recognized.")
+        first_frame = 250*np.ones((420, 650, 3), dtype=np.uint8)
+        photometric_interpretation = "RGB"
+
+    # Downscale first, so that the color conversion only runs on the thumbnail's pixels
+    height, width = first_frame.shape[:2]
+    if (width > THUMBNAIL_WIDTH):
+        thumbnail_height = max(1, round(height*THUMBNAIL_WIDTH/width))
+        first_frame = cv2.resize(first_frame, (THUMBNAIL_WIDTH, thumbnail_height), interpolation=cv2.INTER_AREA)
+
+    thumbnail_rgb = convert_color_space(first_frame, photometric_interpretation, "RGB")
+    # OpenCV encodes BGR images
+    thumbnail_bgr = cv2.cvtColor(thumbnail_rgb.astype(np.uint8, copy=False), cv2.COLOR_RGB2BGR)
+    success, thumbnail_bytes = cv2.imencode('.jpg', thumbnail_bgr, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    if (not success):
+        raise ValueError("Thumbnail could not be encoded as jpg")
+    return thumbnail_bytes.tobytes()
+
+def thumbnail_data_uri(thumbnail_bytes):
+    """
+    Returns the thumbnail's bytes (see make_thumbnail()) as a data URI, to be used as an html.Img's src
+    """
+    return "data:image/jpeg;base64," + base64.b64encode(thumbnail_bytes).decode()
+
 
 ######### File Handlers #######
 # Bellow are all function that deal with reading, storing, deleting or updating data from the filespace
 
+UPLOAD_WORKERS = None # threads ingesting the uploaded files concurrently, None lets ThreadPoolExecutor decide (from the number of cores)
+
+def ingest_upload(content, filename, username):
+    """
+    Decodes the uploaded file's base-64 content, hashes it and reads its DICOM header, then creates its manifest entry and thumbnail
+    Only the first frame is read for the thumbnail (see read_uncompressed_frames()), unless the pixel data is compressed
+    Runs in the upload worker threads, where there is no request context, hence the username argument
+    Returns the file's header (Dataset without the pixel data), its manifest entry, its thumbnail's bytes and the file's bytes,
+    or the error (as a string) if the file could not be read or thumbnailed, so that it does not fail the rest of the upload
+    """
+    try:
+        content_type, content_string = content.split(',')
+        file_bytes = base64.b64decode(content_string)
+        ds, first_frames, nframes = read_uncompressed_frames(io.BytesIO(file_bytes), 0, 1)
+        ds.PatientID # Required, to check that the file belongs to the patient being studied
+        if (first_frames is not None and len(first_frames) > 0):
+            first_frame = first_frames[0]
+        else:
+            first_frame = scan_first_frame(pydicom.dcmread(io.BytesIO(file_bytes)).pixel_array)
+        manifest_entry = scan_manifest_entry(ds, filename, username, hashlib.sha256(file_bytes).hexdigest())
+        thumbnail_bytes = make_thumbnail(first_frame, ds.PhotometricInterpretation)
+    except Exception as e:
+        return type(e).__name__ + ": " + str(e)
+    return (ds, manifest_entry, thumbnail_bytes, file_bytes)
+
+def store_upload(file_bytes, filename, thumbnail_bytes, username):
+    """
+    Stores an accepted uploaded file, as the bytes that were uploaded, and its thumbnail in the user's Dicoms and Thumbnails directories
+    Runs in the upload worker threads, where there is no request context, hence the username argument
+    """
+    with open('./Sessions/' + username + '/Dicoms/' + filename, 'wb') as fp:
+        fp.write(file_bytes)
+    save_thumbnail(username, filename, thumbnail_bytes)
+
 def handle_upload(list_of_contents, list_of_filenames):
     """
     Handles the user's uploaded files
     Returns the new thumbnails (as a 3-element tuple to be later converted into a thumbnail), a list of the uploaded files that were not accepted because they were already
     uploaded and a list of the uploaded files that were not accepted because they belong to a different patient
     than the one currently being studied
+
+    The files are decoded, read and thumbnailed concurrently by a pool of UPLOAD_WORKERS threads, then accepted or
+    rejected in their upload order. Files are recognized as already uploaded by their name or by their contents' hash.
+    The accepted files are stored as uploaded (again concurrently) and the file_indexes, the session manifest and the
+    log are then updated once for the whole upload, each of them replaced atomically.
     """
 
     # Since the callback's output is already in the layout, prevent_initial_call=True will not prevent the callback from being executed
@@ -155,65 +281,28 @@ def handle_upload(list_of_contents, list_of_filenames):
         raise PreventUpdate
 
     username = request.authorization['username']
-    # Check whether this is the beggining of the study and the log should be initialized
-    log_dict_filepath = './Sessions/' + username + '/log'
-    init_log = False
-    if (not os.path.exists(log_dict_filepath)):
-        init_log = True
-    
     already_uploaded_files = []
     diff_patient_files = []
     thumbnail_tuples = []
-    for content, filename in zip(list_of_contents, list_of_filenames):
-        #print('handle_upload has file: ', filename)
 
-        # Check if the file has been uploaded before by the current active user
-        if (is_already_uploaded(filename)):
+    # Check if the files have been uploaded before by the current active user (or more than once in this upload)
+    uploads = []
+    upload_filenames = set()
+    for content, filename in zip(list_of_contents, list_of_filenames):
+        if (is_already_uploaded(filename) or filename in upload_filenames):
             print("File",filename,"has been already uploaded before")
             already_uploaded_files.append(filename)
             continue
-        
-        content_type, content_string = content.split(',')
-
-        # Decode file bytes and read as DICOM file
-        decoded_contents = base64.b64decode(content_string)
-        ds = pydicom.dcmread(io.BytesIO(decoded_contents))
+        uploads.append((content, filename))
+        upload_filenames.add(filename)
+    if (len(uploads) == 0):
+        return (thumbnail_tuples,already_uploaded_files,diff_patient_files)
 
-        # Check if the uploaded file belongs to the currently active patient (can only study one patient at a time)
-        if (is_patient_different(ds)):
-            print("File",filename,"belongs to a different patient than the one currently studied")
-            diff_patient_files.append(filename)
-            continue
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        ingested_uploads = list(executor.map(lambda upload: ingest_upload(upload[0], upload[1], username), uploads))
 
-        # File is accepted
-        if(init_log):
-            write_to_log('current patient ID',ds.PatientID)
-            print("Log Initialized")
-            init_log = False
-        write_to_log('user actions',filename+" uploaded")
-        # Add scans thumbnail in the scans section
-        thumbnail_text = filename
-        # In case AcquisitionDateTime is not provided, catch the resulting error from trying to access it
-        try:
-            thumbnail_text = thumbnail_text + ": " + ds.AcquisitionDateTime[6:8] + "/" + ds.AcquisitionDateTime[4:6] + "/" + \
-                ds.AcquisitionDateTime[0:4] + " " + ds.AcquisitionDateTime[8:10] + ":" + \
-                ds.AcquisitionDateTime[10:12] + ":" + \
-                ds.AcquisitionDateTime[12:14]
-        except:
-            thumbnail_text = thumbnail_text + ": AcquisitionDateTime Not Found"
-        # In case the pixel_array is a single image (not a video) or something else of not acceptable shape, catch that here
-        if (len(ds.pixel_array.shape) == 4):
-            # pixel_array is a video
-            thumbnail_input = ds.pixel_array[0, :, :, :]
-        elif (len(ds.pixel_array.shape) == 3):
-            # pixel_array is a single image
-            thumbnail_input = ds.pixel_array[:, :, :]
-        else:
-            # pixel_array is ?
-            print("Error, pixel_array shape not accepted/recognized.")
-            thumbnail_input = 250*np.ones((420, 650, 3))
-        
-        # Open the file_indexes dictionary and get the last index for this scan
+        # Read the log, the file_indexes dictionary and the manifest once, they are updated in memory for every accepted file
+        log_dict = read_log(username)
         index_dict_path = './Sessions/' + username + '/file_indexes'
         if (not os.path.exists(index_dict_path)):
             # This is the first uploaded scan, create the indexes dictionary
@@ -221,26 +310,62 @@ def handle_upload(list_of_contents, list_of_filenames):
         else:
             with open(index_dict_path, 'r') as fp:
                 index_dict = json.load(fp)
-                
+        manifest = load_manifest(username)
+        uploaded_hashes = set(entry.get('sha256') for entry in manifest.values())
         index_dict_list = list(index_dict) # converts the dict's keys to a list
         if (len(index_dict_list) == 0):
             last_index = -1
         else:
             last_index = int(index_dict_list[-1])
 
-        rgb_image_pixels = convert_color_space(thumbnail_input, "YBR_FULL", "RGB")
-        first_frame_fig = plt.imshow(rgb_image_pixels)
-        first_frame_fig.axes.get_xaxis().set_visible(False)
-        first_frame_fig.axes.get_yaxis().set_visible(False)
-        image_bytes = io.BytesIO()
-        plt.savefig(image_bytes, format='png', bbox_inches='tight', pad_inches=0)
-        plt.close()
-        img_encoding = base64.b64encode(image_bytes.getvalue()).decode()
-        img_b64 = "data:image/png;base64," + img_encoding
-        thumbnail_tuples.append((img_b64, last_index+1, thumbnail_text))
-
-        # Also save the file to this user's directory (server-side)
-        save_ds(ds, filename, last_index+1)
+        accepted_uploads = []
+        unreadable_files = []
+        for (content, filename), ingested_upload in zip(uploads, ingested_uploads):
+            # Skip the files that could not be read, the rest of the upload goes on
+            if (isinstance(ingested_upload, str)):
+                print("File",filename,"could not be read:",ingested_upload)
+                unreadable_files.append((filename, ingested_upload))
+                continue
+            ds, manifest_entry, thumbnail_bytes, file_bytes = ingested_upload
+            # Check if the same file has been uploaded before under another name
+            if (manifest_entry['sha256'] in uploaded_hashes):
+                print("File",filename,"has been already uploaded before")
+                already_uploaded_files.append(filename)
+                continue
+            # Check if the uploaded file belongs to the currently active patient (can only study one patient at a time)
+            # If there is no current patient, this is the beggining of the study and the log is initialized with this file's patient
+            if ('current patient ID' not in log_dict):
+                add_log_entry(log_dict, 'current patient ID', ds.PatientID)
+                print("Log Initialized")
+            elif (log_dict['current patient ID'] != ds.PatientID):
+                print("File",filename,"belongs to a different patient than the one currently studied")
+                diff_patient_files.append(filename)
+                continue
+
+            # File is accepted
+            add_log_entry(log_dict, 'user actions', filename+" uploaded")
+            last_index = last_index + 1
+            index_dict[str(last_index)] = filename
+            manifest[str(last_index)] = manifest_entry
+            uploaded_hashes.add(manifest_entry['sha256'])
+            accepted_uploads.append((file_bytes, filename, thumbnail_bytes))
+            # Add scans thumbnail in the scans section
+            thumbnail_tuples.append((thumbnail_data_uri(thumbnail_bytes), last_index, thumbnail_caption(manifest_entry)))
+
+        # Save the accepted files to this user's directory (server-side)
+        list(executor.map(lambda upload: store_upload(upload[0], upload[1], upload[2], username), accepted_uploads))
+
+    # Log the files that could not be read along with the rest of the upload (there is no log to write them to until the study has started)
+    log_unreadable_files = 'user actions' in log_dict and len(unreadable_files) > 0
+    if (log_unreadable_files):
+        for filename, error in unreadable_files:
+            add_log_entry(log_dict, 'user actions', filename+" could not be read and was skipped ("+error+")")
+
+    if (len(accepted_uploads) > 0):
+        write_json_atomic(index_dict_path, index_dict, indent=4, sort_keys=True)
+        write_manifest(username, manifest)
+    if (len(accepted_uploads) > 0 or log_unreadable_files):
+        write_json_atomic('./Sessions/' + username + '/log', log_dict, indent=4)
 
     return (thumbnail_tuples,already_uploaded_files,diff_patient_files)
 
@@ -248,13 +373,12 @@ def fetch_fields(filename, get_pixel_array=False, get_datetime=False, get_framer
     """
     Returns specific fields from the dicom file specified as filename, in the order specified in the arguments
     
-    :param get_pixel_array (Boolean) Return the pixel_array?
+    :param get_pixel_array (Boolean) Return the pixel_array, in RGB? (read-only, as it is cached for later calls, see fetch_decoded_scan())
     :param get_datetime (Boolean) Return the acquisition datetime?
     :param get_framerate (Boolean) Return the recommended display framerate?
     """
-    username = request.authorization['username']
-    filepath = './Sessions/' + username + '/Dicoms/'+filename
-    ds = pydicom.dcmread(filepath)
+    # The pixel data is decoded (and cached) by fetch_decoded_scan(), only the header is needed here
+    ds = fetch_scan_header(filename)
     dateTime = ds.AcquisitionDateTime[6:8] + "/" + ds.AcquisitionDateTime[4:6] + "/" + \
                 ds.AcquisitionDateTime[0:4] + " " + ds.AcquisitionDateTime[8:10] + ":" + \
                 ds.AcquisitionDateTime[10:12] + ":" + \
@@ -263,7 +387,7 @@ def fetch_fields(filename, get_pixel_array=False, get_datetime=False, get_framer
     
     return_values = []
     if (get_pixel_array):
-        return_values.append(convert_color_space(ds.pixel_array,"YBR_FULL", "RGB"))
+        return_values.append(fetch_decoded_scan(filename).rgb)
     if(get_datetime):
         dateTime = ds.AcquisitionDateTime[6:8] + "/" + ds.AcquisitionDateTime[4:6] + "/" + \
                 ds.AcquisitionDateTime[0:4] + " " + ds.AcquisitionDateTime[8:10] + ":" + \
@@ -275,6 +399,97 @@ def fetch_fields(filename, get_pixel_array=False, get_datetime=False, get_framer
 
     return return_values
 
+def fetch_scan_header(filename, username=None):
+    """
+    Returns the header of the dicom file specified as filename, i.e. its Dataset read without the pixel data
+    (stop_before_pixels), for metadata such as the patient's info, the acquisition datetime, the framerate or the
+    number of frames (see scan_frame_count()) to be read without decoding the scan.
+    Headers are cached for later calls, so the returned Dataset must not be modified.
+    The username defaults to that of the current request's user.
+    """
+    if (username is None):
+        username = request.authorization['username']
+    ds = scan_headers.get((username, filename))
+    if (ds is None):
+        filepath = './Sessions/' + username + '/Dicoms/'+filename
+        ds = pydicom.dcmread(filepath, stop_before_pixels=True)
+        scan_headers.put((username, filename), ds)
+    return ds
+
+def scan_frame_count(ds):
+    """
+    Returns the number of frames of the scan with the header ds, from its NumberOfFrames (absent for single images)
+    """
+    return int(ds.get('NumberOfFrames', 1))
+
+def fetch_decoded_scan(filename):
+    """
+    Returns the DecodedScan of the dicom file specified as filename: its pixel array in its native color space
+    (YBR_FULL for the app's scans, from which the estimators take the luma channel directly) and a lazy RGB view.
+    The file is decoded once; the scan is then cached for later calls.
+    """
+    username = request.authorization['username']
+    scan = decoded_scans.get((username, filename))
+    if (scan is None):
+        filepath = './Sessions/' + username + '/Dicoms/'+filename
+        ds = pydicom.dcmread(filepath)
+        scan = DecodedScan(ds.pixel_array, ds.PhotometricInterpretation)
+        decoded_scans.put((username, filename), scan)
+    return scan
+
+def read_uncompressed_frames(fp, start=0, stop=None):
+    """
+    Reads the header of the DICOM file object fp and, when its pixel data is uncompressed 8-bit RGB or YBR_FULL,
+    frames [start, stop) of it straight from the file, without reading (or decoding) the rest of the pixel data.
+    Returns the header (Dataset without the pixel data), the frames in their native color space, of format
+    (nframes,height,width,3), or None for any other pixel data, and the total number of frames of the scan
+    """
+    ds = pydicom.dcmread(fp, stop_before_pixels=True)
+    nframes = scan_frame_count(ds)
+    if (stop is None or stop > nframes):
+        stop = nframes
+    start = max(0, min(start, stop))
+
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if (transfer_syntax not in (pydicom.uid.ImplicitVRLittleEndian, pydicom.uid.ExplicitVRLittleEndian)
+            or ds.PhotometricInterpretation not in ("YBR_FULL", "RGB") or ds.BitsAllocated != 8):
+        return (ds, None, nframes)
+
+    rows, cols, samples = ds.Rows, ds.Columns, ds.SamplesPerPixel
+    frame_size = rows*cols*samples
+    # dcmread leaves the file positioned at the start of the Pixel Data element; skip its
+    # tag and length (and VR, for explicit VR) to get to the first frame's bytes
+    element_header_length = 8 if transfer_syntax.is_implicit_VR else 12
+    fp.seek(element_header_length + start*frame_size, os.SEEK_CUR)
+    frames = np.frombuffer(fp.read((stop - start)*frame_size), dtype=np.uint8)
+    if (ds.get('PlanarConfiguration', 0) == 0):
+        frames = frames.reshape((stop - start, rows, cols, samples))
+    else:
+        frames = frames.reshape((stop - start, samples, rows, cols)).transpose((0, 2, 3, 1))
+    return (ds, frames, nframes)
+
+def read_scan_frames(filename, start=0, stop=None):
+    """
+    Returns frames [start, stop) of the dicom file specified as filename as an RGB array of format (nframes,height,width,3),
+    along with the total number of frames of the scan.
+    Uncompressed 8-bit pixel data is read straight from the file for the requested frames only (see read_uncompressed_frames()),
+    so the cost is that of the requested frames and not of the entire scan. Any other pixel data is decoded in full and then sliced.
+    """
+    username = request.authorization['username']
+    filepath = './Sessions/' + username + '/Dicoms/'+filename
+    with open(filepath, 'rb') as fp:
+        ds, frames, nframes = read_uncompressed_frames(fp, start, stop)
+    if (frames is not None):
+        return (convert_color_space(frames, ds.PhotometricInterpretation, "RGB"), nframes)
+
+    # Compressed (or otherwise unusual) pixel data, decode the entire scan (unless it is already cached)
+    if (stop is None or stop > nframes):
+        stop = nframes
+    pixel_array_rgb = fetch_fields(filename, get_pixel_array=True)[0]
+    if (nframes == 1):
+        pixel_array_rgb = pixel_array_rgb[np.newaxis]
+    return (pixel_array_rgb[start:stop], nframes)
+
 def is_already_uploaded(uploaded_filename):
     """
     Checks whether the input filename is already in the current user's Dicoms directory
@@ -290,112 +505,155 @@ def is_already_uploaded(uploaded_filename):
             return True
     return False
 
-def is_patient_different(ds):
+def write_json_atomic(filepath, obj, **dump_kwargs):
     """
-    Check's if the patient's ID and name in the provided ds file match
-    the patient's ID and name whose DICOMs are already uploaded
-    Returns True if the patient is different, False if its the same patient
-    
-    NOTE: If this is the first uploaded file in the user's empty directory,
-    the function returns True.
+    Stores obj as JSON in filepath (with json.dump's dump_kwargs), by writing it to a temporary file that then replaces
+    filepath, so that readers never see a partially written file
+    Every call writes its own temporary file (in filepath's directory, so that the replacement is atomic), so concurrent writers
+    of the same file do not interfere: the last replacement wins
     """
-    log_dict = {}
-    username = request.authorization['username']
-    log_dict_filepath = './Sessions/' + username + '/log'
-    if (os.path.exists(log_dict_filepath)):
-        with open(log_dict_filepath, 'r') as fp:
-            log_dict = json.load(fp)
-    
+    temp_fd, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=os.path.basename(filepath) + '.', suffix='.tmp')
     try:
-        if (log_dict['current patient ID'] != ds.PatientID):
-            return True
-    except:
-        # If the above check threw an error, it is because the current patient ID field does not exist
-        # Hence, there is no current patient, so accept this one
-        return False
+        with os.fdopen(temp_fd, 'w') as fp:
+            json.dump(obj, fp, **dump_kwargs)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        os.remove(temp_filepath)
+        raise
 
-def save_ds(ds_file, filename, file_index):
+def scan_first_frame(pixel_array):
     """
-    Stores the upload dicom scan in the current user's DICOMs filepath
-    and updates the index-mapping dictionary
+    Returns the first frame of the given pixel_array, which is either a video (nframes,height,width,3) or a single image (height,width,3)
     """
+    if (pixel_array.ndim == 4):
+        return pixel_array[0]
+    return pixel_array
 
-    username = request.authorization['username']
-    filepath = './Sessions/' + username + '/Dicoms/' + filename
-    ds_file.save_as(filepath)
+def thumbnail_filepath(username, filename):
+    """
+    Returns the path of the stored thumbnail of the user's scan filename, in the user's Thumbnails directory
+    """
+    return './Sessions/' + username + '/Thumbnails/' + filename + '.jpg'
 
-    # Also update the index-mapping dictionary to 
-    # what index this filename corresponds to
-    index_dict_path = './Sessions/' + username + '/file_indexes'
-    if (not os.path.exists(index_dict_path)):
-        # This is the first uploaded scan, create the indexes dictionary
-        index_dict = {}
-    else:
+def save_thumbnail(username, filename, thumbnail_bytes):
+    """
+    Stores the thumbnail (see make_thumbnail()) of the user's scan filename in the user's Thumbnails directory
+    """
+    filepath = thumbnail_filepath(username, filename)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as fp:
+        fp.write(thumbnail_bytes)
+
+def load_thumbnail(username, filename):
+    """
+    Returns the stored thumbnail's bytes of the user's scan filename, or None if it has no stored thumbnail
+    """
+    filepath = thumbnail_filepath(username, filename)
+    if (not os.path.exists(filepath)):
+        return None
+    with open(filepath, 'rb') as fp:
+        return fp.read()
+
+def scan_manifest_entry(ds, filename, username, file_hash):
+    """
+    Returns the session manifest's entry of the scan filename, from its DICOM header ds (pixel data not needed):
+    its acquisition datetime, frame count, dimensions, frame rate, patient ID, thumbnail path and the SHA-256 hash
+    of the file (file_hash, a hex string), by which re-uploads of the same file are detected
+    Missing header fields are stored as None
+    """
+    framerate = ds.get('RecommendedDisplayFrameRate')
+    return {
+        "filename": filename,
+        "acquisition_datetime": ds.get('AcquisitionDateTime'),
+        "nframes": scan_frame_count(ds),
+        "height": ds.get('Rows'),
+        "width": ds.get('Columns'),
+        "framerate": None if framerate is None else float(framerate),
+        "patient_id": ds.get('PatientID'),
+        "thumbnail": thumbnail_filepath(username, filename),
+        "sha256": file_hash
+    }
+
+def thumbnail_caption(manifest_entry):
+    """
+    Returns the text shown under a scan's thumbnail: its filename and acquisition datetime
+    """
+    acquisition_datetime = manifest_entry['acquisition_datetime']
+    if (acquisition_datetime is None):
+        return manifest_entry['filename'] + ": AcquisitionDateTime Not Found"
+    return manifest_entry['filename'] + ": " + acquisition_datetime[6:8] + "/" + acquisition_datetime[4:6] + "/" + \
+        acquisition_datetime[0:4] + " " + acquisition_datetime[8:10] + ":" + \
+        acquisition_datetime[10:12] + ":" + \
+        acquisition_datetime[12:14]
+
+def read_manifest(username):
+    """
+    Returns the user's session manifest, {scan_index: manifest entry (see scan_manifest_entry())} for every uploaded scan,
+    or None if the session has no manifest
+    """
+    manifest_path = './Sessions/' + username + '/manifest'
+    if (not os.path.exists(manifest_path)):
+        return None
+    with open(manifest_path, 'r') as fp:
+        return json.load(fp)
+
+def write_manifest(username, manifest):
+    """
+    Stores the user's session manifest
+    """
+    write_json_atomic('./Sessions/' + username + '/manifest', manifest, indent=4, sort_keys=True)
+
+def rebuild_manifest(username, index_dict):
+    """
+    Builds (and stores) the session manifest of the scans of the index_dict (the file_indexes dictionary) from their
+    DICOM headers, for sessions started before manifests were stored.
+    Scans without a stored thumbnail get one, created from their first frame.
+    """
+    manifest = {}
+    for scan_index in index_dict:
+        filename = index_dict[scan_index]
+        filepath = './Sessions/' + username + '/Dicoms/' + filename
+        with open(filepath, 'rb') as fp:
+            file_hash = hashlib.sha256(fp.read()).hexdigest()
+        manifest[scan_index] = scan_manifest_entry(fetch_scan_header(filename, username), filename, username, file_hash)
+        if (not os.path.exists(thumbnail_filepath(username, filename))):
+            ds = pydicom.dcmread(filepath)
+            save_thumbnail(username, filename, make_thumbnail(scan_first_frame(ds.pixel_array), ds.PhotometricInterpretation))
+    write_manifest(username, manifest)
+    return manifest
+
+def load_manifest(username):
+    """
+    Returns the user's session manifest (see read_manifest()), empty if no scans have been uploaded.
+    A session from before manifests were stored has its manifest built (see rebuild_manifest()) on the first call,
+    so that the manifest always covers every scan of the file_indexes dictionary
+    """
+    manifest = read_manifest(username)
+    if (manifest is None):
+        index_dict_path = './Sessions/' + username + '/file_indexes'
+        if (not os.path.exists(index_dict_path)):
+            return {}
         with open(index_dict_path, 'r') as fp:
             index_dict = json.load(fp)
+        manifest = rebuild_manifest(username, index_dict)
+    return manifest
 
-    # Add the current index:filename entry         
-    index_dict[str(file_index)] = filename
-    #print(index_dict)
-
-    # Save the indexes dictionary
-    with open(index_dict_path, 'w') as fp:
-        json.dump(index_dict, fp, indent=4, sort_keys=True)
-    
 def load_session():
     """
     Load the current user's directory (uploaded files, etc)
+    Returns the thumbnail tuples of the uploaded scans, read from the session manifest alone.
+    The thumbnails' images are given as the URLs they are served at (see the /thumbnails route), for the browser to fetch.
     """
     # toDo: Should  it load more than just load dicom scans? -- LATER
 
     # Check whether there are scans to be loaded
     username = request.authorization['username']
-    index_dict_path = './Sessions/' + username + '/file_indexes'
-    if (not os.path.exists(index_dict_path)):
-        return []
+    manifest = load_manifest(username)
 
-
-    # Go to the file_indexes dict and get the order in which the files should be loaded
-    with open(index_dict_path, 'r') as fp:
-            index_dict = json.load(fp)
-
-    # Load the scans and create the thumbnails
+    # Create the thumbnails, in the order of the scans' indexes
     thumbnail_tuples = []
-    for scan_index in index_dict:
-        filename = index_dict[scan_index]
-        filepath = './Sessions/' + username + '/Dicoms/' + filename
-        thumbnail_text = filename
-
-        ds = pydicom.dcmread(filepath)
-        try:
-            thumbnail_text = thumbnail_text + ": " + ds.AcquisitionDateTime[6:8] + "/" + ds.AcquisitionDateTime[4:6] + "/" + \
-                ds.AcquisitionDateTime[0:4] + " " + ds.AcquisitionDateTime[8:10] + ":" + \
-                ds.AcquisitionDateTime[10:12] + ":" + \
-                ds.AcquisitionDateTime[12:14]
-        except:
-            thumbnail_text = thumbnail_text + ": AcquisitionDateTime Not Found"
-        # In case the pixel_array is a singly image (not a video) or something else of not acceptable shape, catch that here
-        if (len(ds.pixel_array.shape) == 4):
-            # pixel_array is a video
-            thumbnail_input = ds.pixel_array[0, :, :, :]
-        elif (len(ds.pixel_array.shape) == 3):
-            # pixel_array is a single image
-            thumbnail_input = ds.pixel_array[:, :, :]
-        else:
-            # pixel_array is ?
-            print("Error, pixel_array shape not accepted/recognized.")
-            thumbnail_input = 250*np.ones((420, 650, 3))
-
-        rgb_image_pixels = convert_color_space(thumbnail_input, "YBR_FULL", "RGB")
-        first_frame_fig = plt.imshow(rgb_image_pixels)
-        first_frame_fig.axes.get_xaxis().set_visible(False)
-        first_frame_fig.axes.get_yaxis().set_visible(False)
-        image_bytes = io.BytesIO()
-        plt.savefig(image_bytes, format='png', bbox_inches='tight', pad_inches=0)
-        plt.close()
-        img_encoding = base64.b64encode(image_bytes.getvalue()).decode()
-        img_b64 = "data:image/png;base64," + img_encoding
-        thumbnail_tuples.append((img_b64, scan_index, thumbnail_text))
+    for scan_index in manifest:
+        thumbnail_tuples.append(('/thumbnails/' + scan_index, scan_index, thumbnail_caption(manifest[scan_index])))
 
     return thumbnail_tuples
 
@@ -409,11 +667,21 @@ def clear_all_dicom_files():
     filepath = './Sessions/' + username + '/Dicoms/'
     for fname in os.listdir(filepath):
         os.remove(os.path.join(filepath, fname))
+    invalidate_scan(username)
+    # And their thumbnails
+    thumbnails_filepath = './Sessions/' + username + '/Thumbnails/'
+    if (os.path.exists(thumbnails_filepath)):
+        for fname in os.listdir(thumbnails_filepath):
+            os.remove(os.path.join(thumbnails_filepath, fname))
 
     # Also clear the file_indexes dictionary
     index_dict_path = './Sessions/' + username + '/file_indexes'
     if (os.path.exists(index_dict_path)):
         os.remove(index_dict_path)
+    # And the session manifest
+    manifest_path = './Sessions/' + username + '/manifest'
+    if (os.path.exists(manifest_path)):
+        os.remove(manifest_path)
 
 def delete_uploaded_dicom(index):
     """
@@ -431,25 +699,36 @@ def delete_uploaded_dicom(index):
     write_to_log('user actions',filename+" deleted")
 
     # Re-store the mutated dictionary
-    with open(index_dict_path, 'w') as fp:
-        json.dump(index_dict, fp, indent=4, sort_keys=True)
+    write_json_atomic(index_dict_path, index_dict, indent=4, sort_keys=True)
+
+    # Delete the scan's entry from the session manifest as well
+    manifest = read_manifest(username)
+    if (manifest is not None):
+        manifest.pop(index, None)
+        write_manifest(username, manifest)
 
     ## Also delete the actual DICOM file
     dicom_filepath = './Sessions/' + username + '/Dicoms/' + filename
     os.remove(dicom_filepath)
+    invalidate_scan(username, filename)
+    if (os.path.exists(thumbnail_filepath(username, filename))):
+        os.remove(thumbnail_filepath(username, filename))
 
-def write_to_log(category,text):
+def read_log(username):
     """
-    Writes the action performed (must be a string) in the current user's log.
-    Adds the system time the action was performed.
+    Returns the user's log dictionary, empty if the study has not started yet
     """
     log_dict = {}
-    username = request.authorization['username']
     log_dict_filepath = './Sessions/' + username + '/log'
     if (os.path.exists(log_dict_filepath)):
         with open(log_dict_filepath, 'r') as fp:
             log_dict = json.load(fp)
+    return log_dict
 
+def add_log_entry(log_dict, category, text):
+    """
+    Adds the action performed (must be a string) to the given log dictionary, along with the system time it was performed
+    """
     if (category == "user actions"):
         new_log_key = len(log_dict['user actions'])
         entry = {
@@ -467,10 +746,18 @@ def write_to_log(category,text):
             log_dict['user actions'] = {}
     else:
         print("Invalid log category entry")
-    
+
+def write_to_log(category,text):
+    """
+    Writes the action performed (must be a string) in the current user's log.
+    Adds the system time the action was performed.
+    """
+    username = request.authorization['username']
+    log_dict = read_log(username)
+    add_log_entry(log_dict, category, text)
+
     # Update the log dictionary
-    with open(log_dict_filepath, 'w') as fp:
-        json.dump(log_dict, fp, indent=4)
+    write_json_atomic('./Sessions/' + username + '/log', log_dict, indent=4)
 
 def delete_log():
     """
@@ -533,6 +820,14 @@ def delete_estimations():
     if (os.path.exists(estimations_dict_filepath)):
         os.remove(estimations_dict_filepath)
 
+def get_scan_frame_counts():
+    """
+    Returns the number of frames of every uploaded scan of the current user, {scan_index: nframes}, from the session manifest
+    """
+    username = request.authorization['username']
+    manifest = load_manifest(username)
+    return {scan_index: manifest[scan_index]['nframes'] for scan_index in manifest}
+
 def get_estimations_dict():
     """
     Get the estimations dictionary file